@@ -1,17 +1,33 @@
 from flask import Flask, render_template, request, g, redirect, session, url_for, make_response, jsonify, flash, \
-    send_from_directory
+    send_from_directory, Response
 import sqlite3
 from datetime import datetime, timedelta, timezone
+import atexit
 import collections
+import contextlib
+import json
+import bisect
 import math
+import operator
 import requests
 import csv
+import hashlib
+import heapq
+import itertools
 import os
+import queue
 import re
-import pickle
 import sys
+import threading
 import time
+import zlib
+from array import array
+from datetime import date
 from multiprocessing import Pool, cpu_count
+from urllib.parse import urlencode
+from urllib3.exceptions import NewConnectionError
+from disocrdDB import NAME_RUN, STOP_WORDS, WORD_PATTERN, build_missing_derived, create_tables, has_search_index, \
+    local_offset_ms, snowflake_to_ms, upgrade_tables
 
 app = Flask(__name__)
 app.secret_key = 'YOUR_SUPER_SECRET_KEY_CHANGE_THIS'
@@ -21,13 +37,34 @@ app.permanent_session_lifetime = timedelta(days=30)
 DB_DATABASE = 'discord_data.db'
 SERVER_ID = "915249444721668096"
 ITEMS_PER_PAGE = 100
+VISITORS_PER_PAGE = 50  # 首页访客列表每次加载的人数
+SEARCH_PER_PAGE = 20  # 消息搜索每页条数
 CSV_FILENAME = 'members.csv'
-CACHE_FILE = 'cache_data_full.pkl'
+CACHE_FILE = 'cache_data.db'
+CACHE_SCHEMA_VERSION = 1  # 缓存结构变化时 +1，旧缓存会被自动清空重建
+USER_CACHE_SIZE = 256  # 内存中最多缓存多少个用户主页的统计数据
+USER_CACHE_TTL = 3600  # 用户统计缓存有效期 (秒)
+USER_CACHE_DISK_SIZE = 5000  # cache_data.db 中最多保留多少个用户主页的统计数据 (超出时淘汰最早写入的)
+WORD_BATCH_ROWS = 2000  # 词云分词时每次从游标取多少条消息拼接后一起匹配
+WORD_CLOUD_TOP_K = 0  # 0: 全服词频精确统计所有词；>0: 只保留前 K 个高频词 (内存有界，计数误差不超过 总词数 / K)
+RESPONSE_CACHE_MB = 64  # 渲染好的页面 / JSON 最多占用多少内存 (数据有更新时自动失效)
+DB_POOL_SIZE = 8  # 每个进程最多保留多少个只读连接
+DB_CACHE_SIZE_MB = 64  # 每个只读连接的页缓存大小
+DB_MMAP_SIZE_MB = 256  # 只读连接的内存映射大小, 0 为关闭
+DB_CACHED_STATEMENTS = 256  # 每个连接缓存的预编译语句数量
+EVENT_QUEUE_SIZE = 10000  # 访客/主页浏览事件缓冲上限, 满了直接丢弃并计数
+EVENT_FLUSH_INTERVAL = 0.3  # 后台写线程批量落库的间隔 (秒)
+REPORT_MIN_MSGS = 1  # 批量预生成报告 (python app.py --build-reports) 时只生成发言数不少于此值的用户，其余人打开时现算
+REPORT_BATCH_USERS = 200  # 预生成报告时每个进程任务包含的用户数
 CHECKPOINT_INTERVAL = 50
 ADMIN_IDS = ["891196284998930522"]
 DISCORD_CLIENT_ID = "Client ID"  # <--- 填入你的 Client ID
 DISCORD_CLIENT_SECRET = "Client Secret"  # <--- 填入你的 Client Secret
-API_BASE_URL = 'https://discord.com/api/v10'
+API_BASE_URL = os.environ.get('DISCORD_API_BASE_URL', 'https://discord.com/api/v10')  # 测试时可指向本地桩服务
+DISCORD_HTTP_TIMEOUT = (3, 10)  # 请求 Discord API 的 (连接, 读取) 超时 (秒)
+DISCORD_HTTP_POOL_SIZE = 16  # 与 Discord API 保持的长连接数 (所有请求线程共用)
+DISCORD_HTTP_RETRIES = 2  # 429 / 5xx / 连不上时最多重试几次
+DISCORD_RETRY_MAX_WAIT = 5  # 429 要求等待超过这么多秒时不再重试，直接提示登录失败
 
 
 # =========================================
@@ -44,22 +81,84 @@ def log_step(msg):
     print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
 
 
+# 导入器 INTEGER_IDS 模式下 snowflake 以整数存储，读出时转回字符串 (模板拼链接 / JSON 给前端都不丢精度)
+ID_COLUMNS = {'message_id', 'user_id', 'thread_id', 'author_id', 'category_id', 'guild_id', 'reply_to_msg_id',
+              'mentioned_user_id', 'op_msg_id', 'op_message_id', 'op_author_id', 'source_id', 'target_id', 'parent_id', 'requester_id',
+              'target_user_id', 'viewer_user_id'}
+
+
+def id_row_factory(cursor, row):
+    id_idx = [i for i, col in enumerate(cursor.description) if type(row[i]) is int and col[0] in ID_COLUMNS]
+    if id_idx:
+        row = list(row)
+        for i in id_idx: row[i] = str(row[i])
+    return sqlite3.Row(cursor, tuple(row))
+
+
+_read_pool = queue.LifoQueue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def open_read_connection():
+    conn = sqlite3.connect(DB_DATABASE, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA query_only = ON")
+    conn.row_factory = id_row_factory
+    return conn
+
+
 def get_db():
+    """当前请求的只读连接, 从连接池借出, 请求结束时归还。写操作请使用 write_db()。"""
     db = getattr(g, '_database', None)
-    if db is None: db = g._database = sqlite3.connect(DB_DATABASE); db.row_factory = sqlite3.Row
+    if db is None:
+        try:
+            db = _read_pool.get_nowait()
+        except queue.Empty:
+            db = open_read_connection()
+        g._database = db
     return db
 
 
+@contextlib.contextmanager
+def write_db():
+    """串行化所有写入的独立写连接, 正常退出时提交, 出错时回滚。"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = sqlite3.connect(DB_DATABASE, check_same_thread=False, timeout=10,
+                                      cached_statements=DB_CACHED_STATEMENTS)
+            _writer.execute("PRAGMA synchronous = NORMAL")
+            _writer.row_factory = id_row_factory
+        try:
+            yield _writer.cursor()
+            _writer.commit()
+        except Exception:
+            _writer.rollback()
+            raise
+
+
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None: db.close()
+    db = g.pop('_database', None)
+    if db is None: return
+    if _read_pool.qsize() < DB_POOL_SIZE:
+        _read_pool.put(db)
+    else:
+        db.close()
 
 
 def init_db_structure():
     if not os.path.exists(DB_DATABASE): return
     conn = sqlite3.connect(DB_DATABASE);
     cur = conn.cursor()
+    # WAL: 增量导入 (disocrdDB.py --append) 进行时网页仍可正常读取
+    cur.execute("PRAGMA journal_mode=WAL").fetchone()
+    # 补齐新版导入器的表 (旧库缺少的物化表)
+    create_tables(cur)
+    upgrade_tables(cur)
     try:
         cur.execute("ALTER TABLE users ADD COLUMN visited_report INTEGER DEFAULT 0")
     except:
@@ -72,6 +171,15 @@ def init_db_structure():
     # 强制使用新表名，规避旧表结构不兼容问题
     cur.execute(
         """CREATE TABLE IF NOT EXISTS web_visitors (user_id TEXT PRIMARY KEY, username TEXT, nickname TEXT, avatar_url TEXT, last_visit DATETIME)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_visitors_last_visit ON web_visitors(last_visit, user_id)")
+    # 访客总数由触发器维护 (UPSERT 命中已有访客时不触发 INSERT)，首页不必每次 COUNT(*) 全表
+    cur.execute("CREATE TABLE IF NOT EXISTS web_counters (name TEXT PRIMARY KEY, value INTEGER)")
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_visitors_ins AFTER INSERT ON web_visitors BEGIN UPDATE web_counters SET value = value + 1 WHERE name = 'visitors'; END")
+    cur.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_visitors_del AFTER DELETE ON web_visitors BEGIN UPDATE web_counters SET value = value - 1 WHERE name = 'visitors'; END")
+    # 只在第一次 (计数行还不存在) 时全表数一遍
+    cur.execute("INSERT OR IGNORE INTO web_counters (name, value) SELECT 'visitors', COUNT(*) FROM web_visitors")
     cur.execute(
         """CREATE TABLE IF NOT EXISTS profile_views (id INTEGER PRIMARY KEY AUTOINCREMENT, target_user_id TEXT, viewer_user_id TEXT, viewer_name TEXT, viewer_avatar TEXT, timestamp DATETIME, UNIQUE(target_user_id, viewer_user_id))""")
 
@@ -97,13 +205,29 @@ def optimize_database():
     conn = sqlite3.connect(DB_DATABASE);
     cur = conn.cursor()
     try:
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_author ON messages(author_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_timestamp ON messages(timestamp)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_thread ON messages(thread_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_author_ts ON messages(author_id, ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_author_hot ON messages(author_id, reaction_count, ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_ts ON messages(ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_thread_ts ON messages(thread_id, ts)")
+        # 旧索引已被上面的 (…, ts) 复合索引覆盖
+        for old_idx in ('idx_msg_author', 'idx_msg_timestamp', 'idx_msg_thread'):
+            cur.execute(f"DROP INDEX IF EXISTS {old_idx}")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_react_user ON reactions(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_react_msg ON reactions(message_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_mention_msg ON mentions(message_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_reactions ON messages(reaction_count)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_thread_replies ON threads(reply_count)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_thread_op ON threads(op_author_id, reply_count)")
         try:
             cur.execute("CREATE INDEX IF NOT EXISTS idx_stats_count ON user_stats(msg_count)")
+            # 旧版导入器生成的库没有常用表情、词云倒排表等派生数据；按 derived_tables 里的标记补建 (不看表是否为空，
+            # 否则增量导入只写进了新消息的表会被当成已建好)
+            rebuilt = build_missing_derived(cur)
+            if rebuilt: log_step(f"📊 已补建派生表: {', '.join(rebuilt)}")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_user_terms_term ON user_terms(term_id, count)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_rollup_day ON activity_rollup(local_day, local_hour, c, reactions)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_interactions_target ON interactions(target_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_interactions_weight ON interactions(mentions + reactions)")
         except:
             pass
         conn.commit()
@@ -131,6 +255,9 @@ def load_member_csv():
 
 def parse_and_convert(time_str):
     if not time_str: return None
+    if isinstance(time_str, (int, float)):
+        # messages.ts: 毫秒时间戳
+        return datetime.fromtimestamp(time_str / 1000, LOCAL_TZ)
     try:
         clean_val = time_str.split('+')[0].split('.')[0]
         if 'T' in clean_val:
@@ -138,7 +265,7 @@ def parse_and_convert(time_str):
         else:
             fmt = "%Y-%m-%d %H:%M:%S"
         dt_utc = datetime.strptime(clean_val, fmt).replace(tzinfo=timezone.utc)
-        return dt_utc.astimezone(timezone(timedelta(hours=8)))
+        return dt_utc.astimezone(LOCAL_TZ)
     except:
         return None
 
@@ -155,33 +282,81 @@ def raw_datetime_filter(value, format='%Y-%m-%d %H:%M'):
     return dt.strftime(format) if dt else value
 
 
+CHINESE_WORD = re.compile(r'[\u4e00-\u9fa5]+')
+
+
 def is_pure_chinese(word):
     if not word: return False
-    return re.match(r'^[\u4e00-\u9fa5]+$', word) is not None
+    return CHINESE_WORD.fullmatch(word) is not None
 
 
-def get_word_cloud_counter(text_list):
-    text = " ".join([str(t) for t in text_list if t])
-    if len(text) > 5000000: text = text[:5000000]
-    words = re.findall(r'[\u4e00-\u9fa5]{2,}', text)
-    stop_words = {'什么', '这个', '那个', '怎么', '可以', '因为', '所以', '但是', '就是', '这就', '感觉', '时候',
-                  '现在', '还是', '没有', '一样', '知道', '觉得', '出来', '其实', '这种', '那样', '一下', '然后',
-                  '虽然', '不是', '还有', '这里', '那里', '今天', '明天', '真的', '可能', '图片', '表情', '回复',
-                  '一个', '一下', '自己', '只是', '非常', '不能', '不要', '需要', '如果', '以及', '我们', '你们',
-                  '他们', '看到', '不过', '确实', '已经', '大家', '为什么', '不会', '不是', '这样', '那个', '这么',
-                  '那么', '那些', '是不是', '有没有'}
-    filtered_words = [w for w in words if w not in stop_words]
-    return collections.Counter(filtered_words)
+def get_word_cloud_counter(texts, batch_rows=WORD_BATCH_ROWS):
+    """texts 可以是游标等任意迭代器：按批拼接后整体匹配，内存只占一批原文，且不截断"""
+    counter = collections.Counter()
+    texts = iter(texts)
+    while True:
+        batch = list(itertools.islice(texts, batch_rows))
+        if not batch: break
+        counter.update(WORD_PATTERN.findall(" ".join([str(t) for t in batch if t])))
+    # 停用词很少，计数后一次性删除比逐词判断快
+    for w in STOP_WORDS: counter.pop(w, None)
+    return counter
 
 
 def merge_counters(old_counter, new_counter):
+    """把 new_counter 原地累加进 old_counter (Counter 的 + / += 每次都会重扫整个累计结果)"""
     if not old_counter: return new_counter
     if not new_counter: return old_counter
-    return old_counter + new_counter
+    if len(new_counter) > len(old_counter): old_counter, new_counter = new_counter, old_counter
+    old_counter.update(new_counter)
+    return old_counter
+
+
+class SpaceSaving:
+    """Space-Saving 高频词摘要：最多保留 capacity 个词。满了以后新词顶替当前计数最小的词并继承其计数，
+    所以计数只会偏大，且偏差不超过 总词数 / capacity；出现次数超过这个值的词一定还在摘要里"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []  # (count, word)：计数只增不减，堆里的旧计数在弹出时再校正
+
+    def add(self, word, count=1):
+        counts = self.counts
+        if word in counts:
+            counts[word] += count
+            return
+        if len(counts) < self.capacity:
+            counts[word] = count
+        else:
+            floor, victim = self.pop_min()
+            del counts[victim]
+            counts[word] = floor + count
+        heapq.heappush(self.heap, (counts[word], word))
+
+    def update(self, items):
+        for word, count in items: self.add(word, count)
+
+    def pop_min(self):
+        heap, counts = self.heap, self.counts
+        while True:
+            count, word = heap[0]
+            actual = counts[word]
+            if actual == count: return heapq.heappop(heap)
+            heapq.heapreplace(heap, (actual, word))
+
+
+def top_items(counter, k):
+    return heapq.nlargest(k, counter.items(), key=operator.itemgetter(1))
 
 
 def format_word_cloud(counter, limit=None):
     if not counter: return []
+    if limit:
+        # 只取前 limit 个，不对整个词频表排序；混进旧缓存的非中文词时才退回全量过滤
+        valid_items = top_items(counter, limit)
+        if all(is_pure_chinese(k) for k, _ in valid_items):
+            return [{'text': word, 'weight': count} for word, count in valid_items]
     valid_items = [(k, v) for k, v in counter.items() if is_pure_chinese(k)]
     valid_items.sort(key=lambda x: x[1], reverse=True)
     if limit: valid_items = valid_items[:limit]
@@ -206,35 +381,585 @@ def process_messages(cur, raw_messages):
     return messages
 
 
+def encode_cursor(*values):
+    return ':'.join(str(v) for v in values)
+
+
+def decode_cursor(value, size):
+    """翻页游标 "a:b:c" -> [a, b, c] (整数)；格式不对时返回 None (从第一页开始)"""
+    parts = (value or '').split(':')
+    if len(parts) != size: return None
+    try:
+        return [int(p) for p in parts]
+    except ValueError:
+        return None
+
+
+LOCAL_OFFSET_MS = local_offset_ms()
+LOCAL_TZ = timezone(timedelta(milliseconds=LOCAL_OFFSET_MS))  # 页面上显示的时间与图表 / 按天统计用同一个时区
+
+
+def parse_day_span(args):
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD -> (起始日, 结束日)，本地日期、两端都包含；只给一端时另一端不限，
+    都没给或格式不对时返回 None (全部时间)"""
+    bounds = []
+    for name in ('from', 'to'):
+        value = args.get(name, '').strip()
+        try:
+            bounds.append(date.fromisoformat(value).isoformat() if value else None)
+        except ValueError:
+            return None
+    if bounds == [None, None]: return None
+    first, last = bounds[0] or '0001-01-01', bounds[1] or '9999-12-31'
+    return (first, last) if first <= last else (last, first)
+
+
+def span_query(args):
+    """当前请求里的时间范围参数，页面内的链接 / 异步请求原样带上"""
+    return urlencode({k: args[k] for k in ('from', 'to') if args.get(k)})
+
+
+def span_ts_filter(span, column):
+    """本地日期范围 -> "AND column >= ? AND column < ?" (毫秒时间戳，用于 messages.ts / threads.created_at)"""
+    if not span: return "", ()
+    epoch = date(1970, 1, 1).toordinal()
+    first, last = (date.fromisoformat(d).toordinal() - epoch for d in span)
+    return f"AND {column} >= ? AND {column} < ?", (first * 86400000 - LOCAL_OFFSET_MS,
+                                                      (last + 1) * 86400000 - LOCAL_OFFSET_MS)
+
+
+def fetch_leaderboard(cur, limit, after=None, emoji_limit=3):
+    # user_stats 是导入时生成的物化表，按 msg_count 索引倒序读取；after=(msg_count, user_id) 为上一页最后一行
+    where, params = "", ()
+    if after:
+        where, params = "AND (s.msg_count, s.user_id) < (?, ?)", tuple(after)
+    cur.execute(
+        f"SELECT s.user_id, u.username, u.nickname, u.avatar_url, s.msg_count, s.top_emojis FROM user_stats s JOIN users u ON u.user_id = s.user_id WHERE s.msg_count > 0 {where} ORDER BY s.msg_count DESC, s.user_id DESC LIMIT ?",
+        (*params, limit))
+    users = []
+    for row in cur.fetchall():
+        d = dict(row)
+        d['top_emojis'] = json.loads(d['top_emojis'])[:emoji_limit] if d['top_emojis'] else []
+        users.append(d)
+    return users
+
+
+def fetch_visitors(cur, limit, after=None):
+    # 按 idx_visitors_last_visit 倒序读取；after = "last_visit:user_id" (上一页最后一行, last_visit 自身可能含冒号)
+    where, params = "", ()
+    if after:
+        last_visit, _, user_id = after.rpartition(':')
+        if last_visit: where, params = "WHERE (last_visit, user_id) < (?, ?)", (last_visit, user_id)
+    cur.execute(
+        f"SELECT user_id, nickname, username, avatar_url, last_visit FROM web_visitors {where} ORDER BY last_visit DESC, user_id DESC LIMIT ?",
+        (*params, limit))
+    visitors = [dict(r) for r in cur.fetchall()]
+    next_cursor = encode_cursor(visitors[-1]['last_visit'], visitors[-1]['user_id']) if len(visitors) == limit else None
+    return visitors, next_cursor
+
+
+def fetch_activity_charts(cur, merged_ids=None, span=None):
+    """从 activity_rollup 读取每日 / 每小时发言图表 (已是显示时区)；merged_ids 为空时为全服，span 为 (起始日, 结束日)"""
+    clauses, params = [], ()
+    if merged_ids is not None:
+        clauses.append(f"user_id IN ({','.join(['?'] * len(merged_ids))})"); params += tuple(merged_ids)
+    if span:
+        clauses.append("local_day BETWEEN ? AND ?"); params += tuple(span)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    cur.execute(f"SELECT local_day, sum(c) FROM activity_rollup {where} GROUP BY local_day ORDER BY local_day", params)
+    chart_daily = [{'day': day, 'c': c} for day, c in cur.fetchall()]
+    cur.execute(f"SELECT local_hour, sum(c) FROM activity_rollup {where} GROUP BY local_hour", params)
+    hourly = dict(cur.fetchall())
+    chart_hourly = [{'hour': f"{h:02d}:00", 'c': hourly.get(h, 0)} for h in range(24)]
+    return chart_daily, chart_hourly
+
+
+def fetch_word_cloud(cur, merged_ids, limit=50, span=None):
+    # 导入时已分词并按 (用户, 词) 计数，这里只做一次索引范围读取；指定时间范围时合并范围内的分日词频
+    ids_ph = ','.join(['?'] * len(merged_ids))
+    table, where, params = 'user_terms', "", ()
+    if span:
+        table, where, params = 'user_day_terms', "AND ut.local_day BETWEEN ? AND ?", tuple(span)
+    cur.execute(
+        f"SELECT t.term, sum(ut.count) as c FROM {table} ut JOIN terms t ON t.term_id = ut.term_id WHERE ut.user_id IN ({ids_ph}) {where} GROUP BY ut.term_id ORDER BY c DESC LIMIT ?",
+        (*merged_ids, *params, limit))
+    return [{'text': word, 'weight': count} for word, count in cur.fetchall()]
+
+
+def fetch_span_summary(cur, span, word_limit=60, user_limit=12):
+    """首页在时间范围内的统计：计数、图表、词云和排行由 activity_rollup / day_terms 的分日汇总合并而来，
+    热门帖子 / 回复按 created_at / ts 过滤"""
+    cur.execute("SELECT coalesce(sum(c), 0), count(DISTINCT user_id) FROM activity_rollup WHERE local_day BETWEEN ? AND ?",
+                span)
+    total_msgs, total_users = cur.fetchone()
+    ts_where, ts_params = span_ts_filter(span, 'created_at')
+    cur.execute(f"SELECT count(*) FROM threads WHERE true {ts_where}", ts_params)
+    total_threads = cur.fetchone()[0]
+    chart_daily, chart_hourly = fetch_activity_charts(cur, span=span)
+
+    cur.execute(
+        "SELECT t.term, s.c FROM (SELECT term_id, sum(count) AS c FROM day_terms WHERE local_day BETWEEN ? AND ? GROUP BY term_id ORDER BY c DESC LIMIT ?) s JOIN terms t ON t.term_id = s.term_id ORDER BY s.c DESC",
+        (*span, word_limit))
+    server_word_cloud = [{'text': word, 'weight': count} for word, count in cur.fetchall()]
+
+    cur.execute(
+        "SELECT r.user_id, u.username, u.nickname, u.avatar_url, r.msg_count, s.top_emojis FROM (SELECT user_id, sum(c) AS msg_count FROM activity_rollup WHERE local_day BETWEEN ? AND ? GROUP BY user_id ORDER BY msg_count DESC LIMIT ?) r JOIN users u ON u.user_id = r.user_id LEFT JOIN user_stats s ON s.user_id = r.user_id ORDER BY r.msg_count DESC",
+        (*span, user_limit))
+    top_users = []
+    for row in cur.fetchall():
+        d = dict(row)
+        d['top_emojis'] = json.loads(d['top_emojis'])[:5] if d['top_emojis'] else []
+        top_users.append(d)
+    return {'total_msgs': total_msgs, 'total_users': total_users, 'total_threads': total_threads,
+            'chart_daily': chart_daily, 'chart_hourly': chart_hourly, 'server_word_cloud': server_word_cloud,
+            'server_word_rank': server_word_cloud[:15], 'top_users': top_users,
+            'top_threads': fetch_top_threads(cur, span), 'top_hot_msgs': fetch_hot_messages(cur, span, span_msgs=total_msgs)}
+
+
+def fetch_top_threads(cur, span=None, limit=10):
+    """热门帖子 (楼主 + 帖内最多的表情)；给了时间范围时只看该范围内发起的帖子"""
+    # 导入时已算好 reply_count / 楼主，按 reply_count 索引取前 limit 个
+    ts_where, ts_params = span_ts_filter(span, 't.created_at')
+    cur.execute(f"""
+        SELECT t.*, t.reply_count AS msg_count, m.content AS first_content,
+               u.username AS op_username, u.nickname AS op_nickname, u.avatar_url AS op_avatar_url
+        FROM threads t
+        LEFT JOIN messages m ON m.message_id = t.op_message_id
+        LEFT JOIN users u ON u.user_id = t.op_author_id
+        WHERE true {ts_where}
+        ORDER BY t.reply_count DESC LIMIT ?""", (*ts_params, limit))
+    top_threads = []
+    for r in cur.fetchall():
+        d = dict(r)
+        op = {'username': d.pop('op_username'), 'nickname': d.pop('op_nickname'),
+              'avatar_url': d.pop('op_avatar_url')}
+        d['op_user'] = op if op['username'] is not None else {'username': 'Unknown', 'avatar_url': ''}
+        top_threads.append(d)
+    thread_ids = [d['thread_id'] for d in top_threads]
+    thread_emojis = {}
+    if thread_ids:
+        cur.execute(f"""
+            SELECT thread_id, emoji_url, c FROM (
+                SELECT m.thread_id, r.emoji_url, count(*) AS c,
+                       ROW_NUMBER() OVER (PARTITION BY m.thread_id ORDER BY count(*) DESC) AS rn
+                FROM reactions r JOIN messages m ON r.message_id = m.message_id
+                WHERE m.thread_id IN ({','.join(['?'] * len(thread_ids))})
+                GROUP BY m.thread_id, r.emoji_name
+            ) WHERE rn = 1""", thread_ids)
+        thread_emojis = {r['thread_id']: r for r in cur.fetchall()}
+    for d in top_threads:
+        emoji = thread_emojis.get(d['thread_id'])
+        d['top_emoji_url'] = emoji['emoji_url'] if emoji else None
+        d['top_emoji_count'] = emoji['c'] if emoji else 0
+    return top_threads
+
+
+HOT_SPAN_SORT_ROWS = 50000  # 时间范围内消息不超过这么多时按 ts 索引取出再排序，否则沿 reaction_count 索引往下找
+
+
+def fetch_hot_messages(cur, span=None, limit=10, span_msgs=None):
+    """热门回复 (作者 + 帖子名 + 表情明细)；给了时间范围时只看该范围内的消息 (span_msgs: 范围内消息数，用于选索引)"""
+    # 按 messages.reaction_count 索引取前 limit 条，作者 + 帖子名一次 JOIN，表情明细再用一次 IN 查询。
+    # 范围很大时 ts 索引要排序几十万行；范围很窄 (或为空) 时沿 reaction_count 索引要扫很久才凑够 limit 条，
+    # 所以按范围内消息数二选一，"+m.ts" 让 SQLite 不用 ts 索引
+    wide = span_msgs is not None and span_msgs > HOT_SPAN_SORT_ROWS
+    ts_where, ts_params = span_ts_filter(span, '+m.ts' if wide else 'm.ts')
+    cur.execute(f"""
+        SELECT m.*, u.username AS author_username, u.nickname AS author_nickname, u.avatar_url AS author_avatar_url,
+               t.name AS thread_name
+        FROM messages m
+        LEFT JOIN users u ON u.user_id = m.author_id
+        LEFT JOIN threads t ON t.thread_id = m.thread_id
+        WHERE true {ts_where}
+        ORDER BY m.reaction_count DESC LIMIT ?""", (*ts_params, limit))
+    top_hot_msgs = []
+    for r in cur.fetchall():
+        d = dict(r)
+        auth = {'username': d.pop('author_username'), 'nickname': d.pop('author_nickname'),
+                'avatar_url': d.pop('author_avatar_url')}
+        d['author'] = auth if auth['username'] is not None else {'username': 'Unknown', 'avatar_url': ''}
+        if d['thread_name'] is None: d['thread_name'] = 'Unknown'
+        d['detailed_reactions'] = []
+        top_hot_msgs.append(d)
+    if top_hot_msgs:
+        hot_map = {d['message_id']: d for d in top_hot_msgs}
+        cur.execute(
+            f"SELECT message_id, emoji_url, count(*) as count FROM reactions WHERE message_id IN ({','.join(['?'] * len(hot_map))}) GROUP BY message_id, emoji_name",
+            list(hot_map))
+        for r in cur.fetchall():
+            hot_map[r['message_id']]['detailed_reactions'].append({'emoji_url': r['emoji_url'], 'count': r['count']})
+    return top_hot_msgs
+
+
+def count_terms_chunk(args):
+    """Pool worker：汇总 term_id 在 [lo, hi] 内的全服词频。各进程负责的词互不重叠，
+    回传 "词\n词..." 字符串 + 计数数组 (反序列化远快于逐项 pickle 的 Counter)，父进程直接拼接"""
+    db_path, lo, hi, top_k = args
+    # top_k > 0 时每段只回传本段前 K 个词；各段的词互不重叠，全服前 K 一定在这些词里，结果仍是精确的
+    limit = f"ORDER BY c DESC LIMIT {int(top_k)}" if top_k else ""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            f"SELECT t.term, s.c FROM (SELECT term_id, sum(count) AS c FROM user_terms WHERE term_id BETWEEN ? AND ? GROUP BY term_id {limit}) s JOIN terms t ON t.term_id = s.term_id",
+            (lo, hi)).fetchall()
+    finally:
+        conn.close()
+    return '\n'.join(r[0] for r in rows), array('q', [r[1] for r in rows])
+
+
+def load_term_counts(cur, processes=None):
+    """全服词频 = user_terms 按词汇总。导入时已分好词并映射成 term_id，这里按 term_id 分段并行聚合，不用重新分词；
+    每段只读 idx_user_terms_term 索引里自己那一段，总工作量不随进程数增加"""
+    processes = processes or cpu_count()
+    cur.execute("SELECT min(term_id), max(term_id) FROM terms")
+    lo, hi = cur.fetchone()
+    counter = collections.Counter()
+    if lo is None: return counter
+    step = math.ceil((hi - lo + 1) / processes)
+    chunks = [(DB_DATABASE, start, min(start + step - 1, hi), WORD_CLOUD_TOP_K) for start in range(lo, hi + 1, step)]
+    with Pool(processes=processes) as pool:
+        for terms, counts in pool.imap_unordered(count_terms_chunk, chunks):
+            # 分段之间没有重复的词，dict.update 直接拼接即可
+            if terms: dict.update(counter, zip(terms.split('\n'), counts))
+    if WORD_CLOUD_TOP_K: counter = collections.Counter(dict(top_items(counter, WORD_CLOUD_TOP_K)))
+    return counter
+
+
 def analyze_message_chunk(args):
     db_path, start_id, end_id = args
     conn = sqlite3.connect(db_path);
     cur = conn.cursor()
     try:
+        # 直接迭代游标，不 fetchall 整块原文
         cur.execute("SELECT content FROM messages WHERE message_id > ? AND message_id <= ?", (start_id, end_id))
-        contents = [r[0] for r in cur.fetchall()]
-        counter = get_word_cloud_counter(contents)
+        counter = get_word_cloud_counter(r[0] for r in cur)
         conn.close();
-        return counter
+        # 回传 "词\n词..." 字符串 + 计数数组，反序列化比整个 Counter (逐项 pickle) 快得多；词里不会有换行
+        return '\n'.join(counter), array('q', counter.values())
     except:
-        conn.close(); return collections.Counter()
+        conn.close(); return '', array('q')
+
+
+def fetch_interactions(cur, merged_ids, direction, limit):
+    """互动最多的用户 (提及 + 表情)，读 interactions 边表；incoming: 别人 -> 我，outgoing: 我 -> 别人"""
+    me, other = ('target_id', 'source_id') if direction == 'incoming' else ('source_id', 'target_id')
+    ids_ph = ','.join(['?'] * len(merged_ids))
+    cur.execute(
+        f"SELECT u.user_id, u.nickname, u.username, u.avatar_url, sum(e.mentions + e.reactions) as score FROM interactions e JOIN users u ON u.user_id = e.{other} WHERE e.{me} IN ({ids_ph}) AND e.{other} NOT IN ({ids_ph}) GROUP BY e.{other} ORDER BY score DESC LIMIT ?",
+        (*merged_ids, *merged_ids, limit))
+    return [dict(r) for r in cur.fetchall()]
+
+
+def fetch_started_threads(cur, merged_ids, limit, after=None, span=None):
+    """用户发起的帖子，按 (回复数, 帖子 ID) 倒序；与 compute_user_data 的计数一样走 threads(op_author_id, reply_count) 索引。
+    after = 上一页最后一帖的 (reply_count, thread_id)，游标翻页"""
+    ids_ph = ','.join(['?'] * len(merged_ids))
+    ts_where, ts_params = span_ts_filter(span, 't.created_at')
+    keyset = "AND (t.reply_count, t.thread_id) < (?, ?)" if after else ""
+    cur.execute(
+        f"SELECT t.thread_id, t.name, t.created_at, t.reply_count, t.exported_at, t.op_message_id as op_msg_id, m.content as first_content FROM threads t LEFT JOIN messages m ON m.message_id = t.op_message_id WHERE t.op_author_id IN ({ids_ph}) {ts_where} {keyset} ORDER BY t.reply_count DESC, t.thread_id DESC LIMIT ?",
+        (*merged_ids, *ts_params, *(after or []), limit))
+    threads = [dict(r) for r in cur.fetchall()]
+
+    # 楼主消息最多的表情，一次窗口查询取回
+    op_ids = [d['op_msg_id'] for d in threads if d['op_msg_id']]
+    top_emojis = {}
+    if op_ids:
+        cur.execute(f"""
+            SELECT message_id, emoji_url, c FROM (
+                SELECT message_id, emoji_url, count(*) AS c,
+                       ROW_NUMBER() OVER (PARTITION BY message_id ORDER BY count(*) DESC) AS rn
+                FROM reactions WHERE message_id IN ({','.join(['?'] * len(op_ids))})
+                GROUP BY message_id, emoji_name
+            ) WHERE rn = 1""", op_ids)
+        top_emojis = {r['message_id']: r for r in cur.fetchall()}
+    for d in threads:
+        emoji = top_emojis.get(d['op_msg_id'])
+        d['top_emoji_url'] = emoji['emoji_url'] if emoji else None
+        d['top_emoji_count'] = emoji['c'] if emoji else None
+    return threads
+
+
+def compute_user_data(cur, merged_ids, span=None):
+    """用户主页中与分页无关的统计部分，返回 (stats, charts)，结果可直接 JSON 序列化；
+    span 为 (起始日, 结束日) 时只统计这段时间 (表情按消息发送时间算，互动关系没有时间，仍为全部时间)"""
+    ids_ph = ','.join(['?'] * len(merged_ids))
+
+    if span:
+        # 发言数 / 获赞数直接合并 activity_rollup 里范围内的各天
+        cur.execute(
+            f"SELECT coalesce(sum(c), 0), coalesce(sum(reactions), 0) FROM activity_rollup WHERE user_id IN ({ids_ph}) AND local_day BETWEEN ? AND ?",
+            (*merged_ids, *span))
+        msg_count, reaction_received_count = cur.fetchone()
+    else:
+        cur.execute(f"SELECT count(DISTINCT message_id) as c FROM messages WHERE author_id IN ({ids_ph})", merged_ids)
+        msg_count = cur.fetchone()['c']
+        cur.execute(
+            f"SELECT count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph})",
+            merged_ids)
+        reaction_received_count = cur.fetchone()['c']
+
+    ts_where, ts_params = span_ts_filter(span, 'created_at')
+    cur.execute(f"SELECT count(*) as c FROM threads WHERE op_author_id IN ({ids_ph}) {ts_where}", (*merged_ids, *ts_params));
+    thread_count = cur.fetchone()['c']
+    ts_where, ts_params = span_ts_filter(span, 'm.ts')
+    given_from = "reactions r JOIN messages m ON r.message_id = m.message_id" if span else "reactions r"
+    cur.execute(
+        f"SELECT r.emoji_url, r.emoji_name, count(*) as c FROM {given_from} WHERE r.user_id IN ({ids_ph}) {ts_where} GROUP BY r.emoji_name ORDER BY c DESC LIMIT 8",
+        (*merged_ids, *ts_params));
+    top_emojis_given = [dict(r) for r in cur.fetchall()]
+    cur.execute(
+        f"SELECT r.emoji_url, r.emoji_name, count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph}) {ts_where} GROUP BY r.emoji_name ORDER BY c DESC LIMIT 8",
+        (*merged_ids, *ts_params));
+    top_emojis_received = [dict(r) for r in cur.fetchall()]
+    interactions_incoming = fetch_interactions(cur, merged_ids, 'incoming', 5)
+    interactions_outgoing = fetch_interactions(cur, merged_ids, 'outgoing', 5)
+
+    chart_daily, chart_hourly = fetch_activity_charts(cur, merged_ids, span)
+
+    word_cloud_data = fetch_word_cloud(cur, merged_ids, 50, span)
+
+    stats = {'msg_count': msg_count, 'reaction_received_count': reaction_received_count, 'thread_count': thread_count,
+             'top_emojis_given': top_emojis_given, 'top_emojis_received': top_emojis_received,
+             'interactions_incoming': interactions_incoming, 'interactions_outgoing': interactions_outgoing}
+    charts = {'chart_daily': chart_daily, 'chart_hourly': chart_hourly, 'word_cloud_data': word_cloud_data}
+    return stats, charts
+
+
+def msg_percentile(cur, msg_count, sorted_counts=None):
+    """击败全服百分比：发言数少于 msg_count 的用户占有发言用户的比例；批量生成报告时传入排好序的全部发言数，免得每人查一次"""
+    if sorted_counts is None:
+        cur.execute(
+            "SELECT (SELECT count(*) FROM user_stats WHERE msg_count > 0), (SELECT count(*) FROM user_stats WHERE msg_count > 0 AND msg_count < ?)",
+            (msg_count,))
+        total, below = cur.fetchone()
+    else:
+        total, below = len(sorted_counts), bisect.bisect_left(sorted_counts, msg_count)
+    return int(100 * (below or 0) / total) if total else 0
+
+
+def pack_report(report):
+    return zlib.compress(json.dumps(report, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def unpack_report(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def compute_report(cur, merged_ids, span=None, sorted_counts=None):
+    """年度报告的全部数据 (可直接 JSON 序列化)；span 为 (起始日, 结束日) 时只统计这段时间 (初次相遇仍按全部时间)"""
+    ids_ph = ','.join(['?'] * len(merged_ids))
+    day_where, day_params = ("AND local_day BETWEEN ? AND ?", span) if span else ("", ())
+    ts_where, ts_params = span_ts_filter(span, 'm.ts')
+
+    report = {}
+    cur.execute(f"SELECT min(ts) as joined FROM messages WHERE author_id IN ({ids_ph})", merged_ids)
+    joined_row = cur.fetchone();
+    if joined_row and joined_row['joined']:
+        report['join_date'] = datetimeformat_filter(joined_row['joined'], '%Y-%m-%d')
+    else:
+        report['join_date'] = "未知"
+
+    cur.execute(
+        f"SELECT local_day as day, sum(c) as c FROM activity_rollup WHERE user_id IN ({ids_ph}) {day_where} GROUP BY local_day ORDER BY c DESC LIMIT 1",
+        (*merged_ids, *day_params))
+    row = cur.fetchone();
+    report['most_active_day'] = dict(row) if row else None
+
+    # 深夜 = 显示时区 (LOCAL_TIME_OFFSET) 的 0~6 点，与活跃度图表的小时一致
+    cur.execute(
+        f"SELECT * FROM messages m WHERE author_id IN ({ids_ph}) AND (ts + ?) / 3600000 % 24 < 6 {ts_where} ORDER BY ts DESC LIMIT 1",
+        (*merged_ids, LOCAL_OFFSET_MS, *ts_params))
+    late = cur.fetchone()
+    if late:
+        d = dict(late);
+        cur.execute("SELECT name FROM threads WHERE thread_id=?", (d['thread_id'],));
+        tn = cur.fetchone()
+        d['thread_name'] = tn['name'] if tn else 'Unknown';
+        report['latest_msg'] = d
+    else:
+        report['latest_msg'] = None
+
+    started = fetch_started_threads(cur, merged_ids, 1, span=span)
+    if started:
+        report['most_replied_thread'] = started[0]
+    else:
+        report['most_replied_thread'] = None
+
+    cur.execute(
+        f"SELECT t.thread_id, t.name, count(*) as c FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) {ts_where} GROUP BY t.thread_id ORDER BY c DESC LIMIT 1",
+        (*merged_ids, *ts_params))
+    row = cur.fetchone();
+    report['most_active_topic'] = dict(row) if row else None
+
+    cur.execute(
+        f"SELECT m.*, t.name as thread_name, m.reaction_count as rc FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) {ts_where} ORDER BY m.reaction_count DESC LIMIT 1",
+        (*merged_ids, *ts_params))
+    row = cur.fetchone()
+    if row:
+        d = dict(row);
+        cur.execute("SELECT emoji_url, count(*) as count FROM reactions WHERE message_id = ? GROUP BY emoji_name",
+                    (d['message_id'],));
+        d['detailed_reactions'] = [dict(r) for r in cur.fetchall()];
+        report['most_liked_msg'] = d
+    else:
+        report['most_liked_msg'] = None
+
+    friends = fetch_interactions(cur, merged_ids, 'incoming', 1)
+    report['top_friend_incoming'] = friends[0] if friends else None
+    friends = fetch_interactions(cur, merged_ids, 'outgoing', 1)
+    report['top_friend_outgoing'] = friends[0] if friends else None
+
+    report['word_cloud_data'] = fetch_word_cloud(cur, merged_ids, 50, span)
+    cur.execute(f"SELECT coalesce(sum(msg_count), 0) FROM user_stats WHERE user_id IN ({ids_ph})", merged_ids)
+    report['percentile'] = msg_percentile(cur, cur.fetchone()[0], sorted_counts)
+    return report
+
+
+class CacheStore:
+    """DataEngine 的磁盘缓存 (SQLite)：首页 / 全服词频 / 用户 分区存放，可以只读取需要的部分"""
+
+    def __init__(self, path):
+        self.path = path
+        self.ready = False  # 建表只在本进程第一次连接时做一次
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        if not self.ready:
+            self.setup(conn)
+            self.ready = True
+        return conn
+
+    def setup(self, conn):
+        # WAL: 用户缓存的后台批量写入不阻塞页面读取缓存 (journal_mode 记录在库文件里，设一次即可)
+        conn.execute("PRAGMA journal_mode=WAL").fetchone()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_SCHEMA_VERSION:
+            for table in ('cache_meta', 'cache_sections', 'cache_words', 'cache_users', 'cache_reports'):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_sections (name TEXT PRIMARY KEY, payload TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_words (term TEXT PRIMARY KEY, count INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_words_count ON cache_words(count)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_users (cache_key TEXT PRIMARY KEY, last_msg_id TEXT, payload TEXT, updated_at DATETIME)")
+        # 报告快照：按 (用户, 合并后的 ID 集合) 存 zlib 压缩的 JSON
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_reports (user_id TEXT, merge_key TEXT, last_msg_id TEXT, payload BLOB, PRIMARY KEY (user_id, merge_key)) WITHOUT ROWID")
+        conn.commit()
+
+    def load_meta(self):
+        conn = self.connect()
+        try:
+            return dict(conn.execute("SELECT key, value FROM cache_meta").fetchall())
+        finally:
+            conn.close()
+
+    def load_section(self, name):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT payload FROM cache_sections WHERE name = ?", (name,)).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def load_word_counter(self):
+        conn = self.connect()
+        try:
+            return collections.Counter(dict(conn.execute("SELECT term, count FROM cache_words")))
+        finally:
+            conn.close()
+
+    def top_words(self, limit):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT term, count FROM cache_words ORDER BY count DESC LIMIT ?", (limit,)).fetchall()
+        finally:
+            conn.close()
+
+    def save(self, last_msg_id, sections, word_counter=None):
+        conn = self.connect()
+        try:
+            for name, payload in sections.items():
+                conn.execute("INSERT OR REPLACE INTO cache_sections (name, payload) VALUES (?, ?)",
+                             (name, json.dumps(payload, ensure_ascii=False)))
+            if word_counter is not None:
+                # 整表重写：先删索引、按主键顺序插入再建索引，比逐行随机插入 B 树快得多
+                conn.execute("DROP INDEX IF EXISTS idx_cache_words_count")
+                conn.execute("DELETE FROM cache_words")
+                conn.executemany("INSERT INTO cache_words (term, count) VALUES (?, ?)", sorted(word_counter.items()))
+                conn.execute("CREATE INDEX idx_cache_words_count ON cache_words(count)")
+            conn.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('last_msg_id', ?)", (str(last_msg_id),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """供 EventWriter 后台批量写入用，退出时提交"""
+        conn = self.connect()
+        try:
+            yield conn.cursor()
+            conn.commit()
+        finally:
+            conn.close()
+
+    def load_user(self, cache_key, last_msg_id):
+        """只返回与库中最新消息一致、且未超过 USER_CACHE_TTL 的缓存"""
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT payload FROM cache_users WHERE cache_key = ? AND last_msg_id = ? AND updated_at >= ?",
+                               (cache_key, str(last_msg_id), datetime.now() - timedelta(seconds=USER_CACHE_TTL))).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def load_report(self, user_id, merge_key):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT last_msg_id, payload FROM cache_reports WHERE user_id = ? AND merge_key = ?",
+                               (str(user_id), merge_key)).fetchone()
+            return (row[0], unpack_report(row[1])) if row else (None, None)
+        finally:
+            conn.close()
+
+    def save_reports(self, last_msg_id, rows):
+        """rows: [(user_id, merge_key, 已压缩的 payload), ...]"""
+        conn = self.connect()
+        try:
+            conn.executemany("INSERT OR REPLACE INTO cache_reports VALUES (?, ?, ?, ?)",
+                             [(str(uid), key, str(last_msg_id), payload) for uid, key, payload in rows])
+            conn.commit()
+        finally:
+            conn.close()
 
 
 class DataEngine:
     def __init__(self):
-        self.cache = {"homepage": {}, "users": {}, "last_msg_id": 0, "global_word_counter": collections.Counter(),
+        self.cache = {"homepage": {}, "users": collections.OrderedDict(), "last_msg_id": 0, "global_word_counter": collections.Counter(),
                       "merges": {}}
+        self.store = CacheStore(CACHE_FILE)
+        self.user_lock = threading.Lock()
+        self.merges_gen = 0  # 合并关系每改一次 +1，作为响应缓存数据版本的一部分
+        self.merges_changed_at = 0
 
-    def save_to_disk(self):
+    def save_to_disk(self, save_words=True):
         try:
-            temp_file = CACHE_FILE + '.tmp'
-            with open(temp_file, 'wb') as f:
-                pickle.dump(self.cache, f)
-            if os.path.exists(CACHE_FILE): os.remove(CACHE_FILE)
-            os.rename(temp_file, CACHE_FILE)
+            self.store.save(self.cache["last_msg_id"], {"homepage": self.cache["homepage"]},
+                            self.cache["global_word_counter"] if save_words else None)
         except Exception as e:
             print(f"❌ 保存失败: {e}")
 
+    def get_server_word_cloud(self, limit):
+        # 词频表只在增量计算时才完整载入内存，平时直接从缓存库按 count 索引取前 N 个
+        if self.cache.get("global_word_counter"):
+            return format_word_cloud(self.cache["global_word_counter"], limit)
+        try:
+            return [{'text': word, 'weight': count} for word, count in self.store.top_words(limit)]
+        except Exception:
+            return []
+
     def load_merges(self, cur):
         cur.execute("SELECT target_id, parent_id FROM user_merges")
         self.cache['merges'] = {row['target_id']: row['parent_id'] for row in cur.fetchall()}
@@ -254,7 +979,7 @@ class DataEngine:
     def load_or_compute(self):
         log_step(">> 初始化引擎...")
         conn = sqlite3.connect(DB_DATABASE);
-        conn.row_factory = sqlite3.Row;
+        conn.row_factory = id_row_factory;
         cur = conn.cursor()
         try:
             cur.execute("SELECT MAX(message_id) FROM messages"); db_max_id = cur.fetchone()[0]
@@ -265,138 +990,444 @@ class DataEngine:
         self.load_merges(cur)
 
         loaded = False
-        if os.path.exists(CACHE_FILE):
-            try:
-                log_step(">> 读取本地缓存...")
-                with open(CACHE_FILE, 'rb') as f:
-                    disk_cache = pickle.load(f)
-                    if 'merges' not in disk_cache: disk_cache['merges'] = {}
-                    disk_cache['merges'] = self.cache['merges']
-                    self.cache = disk_cache
-                    self.force_clean_cache()
-                    if str(disk_cache.get("last_msg_id")) == str(db_max_id):
-                        loaded = True
-            except:
-                pass
+        try:
+            meta = self.store.load_meta()
+            if meta:
+                # 启动时只读 meta 和首页分区，不载入全服词频表
+                log_step(">> 读取本地缓存 (首页分区)...")
+                self.cache["last_msg_id"] = meta.get("last_msg_id", 0)
+                self.cache["homepage"] = self.store.load_section("homepage") or {}
+                loaded = str(self.cache["last_msg_id"]) == str(db_max_id)
+        except Exception as e:
+            print(f"❌ 读取缓存失败: {e}")
 
         if loaded:
-            log_step("✅ 缓存有效，刷新首页...")
-            self.refresh_homepage_stats(cur, db_max_id)
+            log_step("✅ 缓存有效")
+            self.cache["global_word_counter"] = collections.Counter()
+            if not self.cache["homepage"]: self.refresh_homepage_stats(cur, db_max_id)
             conn.close();
             return
 
         log_step(f"🚀 增量计算 (DB: {db_max_id})")
         min_id = self.cache.get("last_msg_id", 0)
+        words_changed = False
         cur.execute("SELECT count(*) FROM messages WHERE message_id > ?", (min_id,))
-        if cur.fetchone()[0] > 0:
-            cur.execute("SELECT message_id FROM messages WHERE message_id > ? ORDER BY message_id", (min_id,))
-            all_ids = [r[0] for r in cur.fetchall()]
-            chunk_size = math.ceil(len(all_ids) / (cpu_count() * 4));
-            chunks = []
-            for i in range(0, len(all_ids), chunk_size):
-                chunk_ids = all_ids[i:i + chunk_size]
-                if chunk_ids: chunks.append((DB_DATABASE, int(chunk_ids[0]) - 1, int(chunk_ids[-1])))
-
-            new_counter = collections.Counter()
-            with Pool(processes=cpu_count()) as pool:
-                for res in pool.imap_unordered(analyze_message_chunk, chunks): new_counter += res
-            self.cache["global_word_counter"] = merge_counters(self.cache.get("global_word_counter"), new_counter)
-            self.force_clean_cache()
+        new_msgs = cur.fetchone()[0]
+        if new_msgs > 0:
+            words_changed = True
+            cur.execute("SELECT EXISTS (SELECT 1 FROM user_terms)")
+            if cur.fetchone()[0]:
+                # 倒排表是累计的，每次直接整表汇总即可，不需要旧词频也不需要多进程
+                log_step(">> 汇总词频倒排表...")
+                self.cache["global_word_counter"] = load_term_counts(cur)
+            else:
+                self.count_words_parallel(conn, cur, min_id, new_msgs)
 
         self.refresh_homepage_stats(cur, db_max_id)
         self.cache["last_msg_id"] = db_max_id
-        self.save_to_disk()
+        self.save_to_disk(save_words=words_changed)
         conn.close()
 
-    def refresh_homepage_stats(self, cur, db_max_id):
-        conn = sqlite3.connect(DB_DATABASE);
-        conn.row_factory = sqlite3.Row;
-        cur = conn.cursor()
+    def count_words_parallel(self, conn, cur, min_id, new_msgs):
+        """没有词云倒排表时 (建表失败等) 才退回多进程重新分词"""
+        if min_id:
+            log_step(">> 载入全服词频分区...")
+            self.cache["global_word_counter"] = self.store.load_word_counter()
+        # 只取每块的首尾 ID 作为范围；raw 游标不经过 id_row_factory
+        chunk_size = math.ceil(new_msgs / (cpu_count() * 4));
+        raw = conn.cursor();
+        raw.row_factory = None
+        raw.execute("SELECT message_id FROM messages WHERE message_id > ? ORDER BY message_id", (min_id,))
+        chunks, first, last = [], None, None
+        for i, (msg_id,) in enumerate(raw):
+            if i % chunk_size == 0:
+                if first is not None: chunks.append((DB_DATABASE, int(first) - 1, int(last)))
+                first = msg_id
+            last = msg_id
+        if first is not None: chunks.append((DB_DATABASE, int(first) - 1, int(last)))
+
+        if WORD_CLOUD_TOP_K:
+            # 有界模式：各块的完整词频和旧词频都汇入同一个 Space-Saving 摘要，父进程内存始终只有 K 个词。
+            # 不能先截成每块的前 K 个：被截掉的计数摘要看不到，计数就会偏小，误差上界也不再成立
+            summary = SpaceSaving(WORD_CLOUD_TOP_K)
+            summary.update((self.cache.get("global_word_counter") or {}).items())
+            with Pool(processes=cpu_count()) as pool:
+                for terms, counts in pool.imap_unordered(analyze_message_chunk, chunks):
+                    if terms: summary.update(zip(terms.split('\n'), counts))
+            self.cache["global_word_counter"] = collections.Counter(summary.counts)
+        else:
+            new_counter = collections.Counter()
+            with Pool(processes=cpu_count()) as pool:
+                for terms, counts in pool.imap_unordered(analyze_message_chunk, chunks):
+                    if terms: new_counter = merge_counters(new_counter, collections.Counter(dict(zip(terms.split('\n'), counts))))
+            self.cache["global_word_counter"] = merge_counters(self.cache.get("global_word_counter"), new_counter)
+        self.force_clean_cache()
 
-        server_word_cloud = format_word_cloud(self.cache["global_word_counter"], 60)
+    def refresh_homepage_stats(self, cur, db_max_id):
+        # 全部用集合查询一次取回，再在 Python 里按 id 拼装，避免逐行 N+1 查询
+        server_word_cloud = self.get_server_word_cloud(60)
         server_word_rank = server_word_cloud[:15]
 
-        cur.execute("SELECT COUNT(*) FROM messages");
-        total_msgs = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM threads");
-        total_threads = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users");
-        total_users = cur.fetchone()[0]
-
-        cur.execute("SELECT substr(timestamp, 1, 10) as day, count(*) as c FROM messages GROUP BY day ORDER BY day")
-        chart_daily = [dict(zip(['day', 'c'], r)) for r in cur.fetchall()]
-        cur.execute("SELECT strftime('%H', timestamp) as hour, count(*) as c FROM messages GROUP BY hour")
-        hourly_raw = {r[0]: r[1] for r in cur.fetchall()};
-        chart_hourly = [0] * 24
-        for h, c in hourly_raw.items():
-            try:
-                chart_hourly[(int(h) + 8) % 24] += c
-            except:
-                pass
-        chart_hourly = [{'hour': f"{h:02d}:00", 'c': c} for h, c in enumerate(chart_hourly)]
-
         cur.execute(
-            "SELECT u.user_id, u.username, u.nickname, u.avatar_url, count(m.message_id) as msg_count FROM users u JOIN messages m ON u.user_id = m.author_id GROUP BY u.user_id ORDER BY msg_count DESC LIMIT 12")
-        top_users = []
-        for u in cur.fetchall():
-            d = dict(u);
-            cur.execute(
-                "SELECT r.emoji_url, r.emoji_name, count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id = ? GROUP BY r.emoji_name ORDER BY c DESC LIMIT 5",
-                (u['user_id'],));
-            d['top_emojis'] = [dict(r) for r in cur.fetchall()];
-            top_users.append(d)
+            "SELECT (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM threads), (SELECT COUNT(*) FROM users)")
+        total_msgs, total_threads, total_users = cur.fetchone()
 
-        cur.execute("SELECT thread_id, count(*) as c FROM messages GROUP BY thread_id ORDER BY c DESC LIMIT 10")
-        top_threads = []
-        for r in cur.fetchall():
-            cur.execute("SELECT * FROM threads WHERE thread_id=?", (r['thread_id'],));
-            t = cur.fetchone()
-            if t:
-                d = dict(t);
-                d['msg_count'] = r['c'];
-                cur.execute(
-                    "SELECT username, avatar_url FROM users WHERE user_id=(SELECT author_id FROM messages WHERE thread_id=? LIMIT 1)",
-                    (d['thread_id'],));
-                op = cur.fetchone()
-                d['op_user'] = dict(op) if op else {'username': 'Unknown', 'avatar_url': ''}
-                cur.execute(
-                    "SELECT emoji_url, count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.thread_id=? GROUP BY emoji_name ORDER BY c DESC LIMIT 1",
-                    (d['thread_id'],))
-                emoji = cur.fetchone()
-                d['top_emoji_url'] = emoji['emoji_url'] if emoji else None
-                d['top_emoji_count'] = emoji['c'] if emoji else 0
-                top_threads.append(d)
-
-        cur.execute("SELECT message_id, count(*) as c FROM reactions GROUP BY message_id ORDER BY c DESC LIMIT 10")
-        top_hot_msgs = []
-        for r in cur.fetchall():
-            cur.execute("SELECT * FROM messages WHERE message_id=?", (r['message_id'],));
-            m = cur.fetchone()
-            if m:
-                d = dict(m);
-                cur.execute("SELECT username, nickname, avatar_url FROM users WHERE user_id=?", (d['author_id'],));
-                auth = cur.fetchone()
-                d['author'] = dict(auth) if auth else {'username': 'Unknown', 'avatar_url': ''}
-                cur.execute("SELECT name FROM threads WHERE thread_id=?", (d['thread_id'],));
-                tn = cur.fetchone()
-                d['thread_name'] = tn['name'] if tn else 'Unknown'
-                cur.execute("SELECT emoji_url, count(*) as count FROM reactions WHERE message_id=? GROUP BY emoji_name",
-                            (d['message_id'],));
-                d['detailed_reactions'] = [dict(row) for row in cur.fetchall()]
-                top_hot_msgs.append(d)
+        chart_daily, chart_hourly = fetch_activity_charts(cur)
+
+        top_users = fetch_leaderboard(cur, 12, emoji_limit=5)
+
+        top_threads = fetch_top_threads(cur)
+        top_hot_msgs = fetch_hot_messages(cur)
 
         self.cache["homepage"] = {'total_threads': total_threads, 'total_users': total_users, 'total_msgs': total_msgs,
                                   'chart_daily': chart_daily, 'chart_hourly': chart_hourly,
                                   'server_word_cloud': server_word_cloud, 'server_word_rank': server_word_rank,
                                   'top_users': top_users, 'top_threads': top_threads, 'top_hot_msgs': top_hot_msgs}
-        conn.close()
 
-    def get_user_data(self, user_id):
-        return {}, {}
+    def get_user_data(self, user_id, cur, span=None):
+        """用户主页统计 (LRU + TTL)，按合并后的 ID 集合 (与时间范围) 缓存，库中有新消息时自动失效"""
+        merged_ids = self.get_merged_ids(user_id)
+        cache_key = ','.join(sorted(merged_ids))
+        if span: cache_key += '@' + '~'.join(span)
+        cur.execute("SELECT MAX(message_id) FROM messages")
+        db_max_id = str(cur.fetchone()[0] or 0)
+
+        users = self.cache["users"]
+        with self.user_lock:
+            entry = users.get(cache_key)
+            if entry and entry['last_msg_id'] == db_max_id and time.time() - entry['time'] < USER_CACHE_TTL:
+                users.move_to_end(cache_key)
+                return entry['stats'], entry['charts']
+
+        # 只有不带时间范围的主页统计落盘 (任意范围组合会让缓存库无限增长)，且由后台线程写入，请求不等待
+        payload = None
+        if not span:
+            try:
+                payload = self.store.load_user(cache_key, db_max_id)
+            except Exception:
+                pass
+        if payload:
+            stats, charts = payload['stats'], payload['charts']
+        else:
+            stats, charts = compute_user_data(cur, merged_ids, span)
+            if not span:
+                now = datetime.now()
+                user_cache_writer.put(USER_CACHE_UPSERT, cache_key, (
+                    cache_key, db_max_id, json.dumps({'stats': stats, 'charts': charts}, ensure_ascii=False), now))
+                user_cache_writer.put(USER_CACHE_PRUNE, None,
+                                      (db_max_id, now - timedelta(seconds=USER_CACHE_TTL), USER_CACHE_DISK_SIZE))
+
+        with self.user_lock:
+            users[cache_key] = {'last_msg_id': db_max_id, 'time': time.time(), 'stats': stats, 'charts': charts}
+            users.move_to_end(cache_key)
+            while len(users) > USER_CACHE_SIZE: users.popitem(last=False)
+        return stats, charts
+
+    def get_report(self, user_id, cur):
+        """年度报告：优先读批量预生成的快照 (合并关系与库中最新消息都一致时)，否则现算并存为快照"""
+        merged_ids = self.get_merged_ids(user_id)
+        merge_key = ','.join(sorted(merged_ids))
+        cur.execute("SELECT MAX(message_id) FROM messages")
+        db_max_id = str(cur.fetchone()[0] or 0)
+        try:
+            last_msg_id, report = self.store.load_report(user_id, merge_key)
+            if last_msg_id == db_max_id:
+                METRICS['report_snapshot_hits'] += 1
+                return report
+        except Exception as e:
+            print(f"❌ 读取报告快照失败: {e}")
+        METRICS['report_snapshot_misses'] += 1
+        report = compute_report(cur, merged_ids)
+        try:
+            self.store.save_reports(db_max_id, [(user_id, merge_key, pack_report(report))])
+        except Exception as e:
+            print(f"❌ 保存报告快照失败: {e}")
+        return report
+
+    def invalidate_user(self, *user_ids):
+        """合并 / 解除合并后，丢弃包含这些 ID 的缓存"""
+        user_ids = {str(u) for u in user_ids}
+        with self.user_lock:
+            for key in [k for k in self.cache["users"] if user_ids & set(k.split('@')[0].split(','))]:
+                del self.cache["users"][key]
+
+    def clear_user_cache(self):
+        with self.user_lock:
+            self.cache["users"].clear()
+
+    def touch_merges(self):
+        self.merges_gen += 1
+        self.merges_changed_at = time.time()
+
+    def data_version(self, cur):
+        """(版本号, 最后修改时间)：库中最新消息 ID + 合并关系版本，任一变化都会让响应缓存失效"""
+        cur.execute("SELECT MAX(message_id) FROM messages")
+        last_msg_id = cur.fetchone()[0] or 0
+        modified = max(snowflake_to_ms(last_msg_id) / 1000 if last_msg_id else 0, self.merges_changed_at)
+        return f"{last_msg_id}-{self.merges_gen}", datetime.fromtimestamp(int(modified), timezone.utc)
 
 
 data_engine = DataEngine()
 
+REPORT_WORKER = {}
+
+
+def init_report_worker(db_path, sorted_counts):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = id_row_factory
+    REPORT_WORKER['cur'] = conn.cursor()
+    REPORT_WORKER['sorted_counts'] = sorted_counts
+
+
+def report_chunk(groups):
+    """groups: [(user_id, merged_ids), ...] -> [(user_id, merge_key, 压缩后的报告), ...]"""
+    cur, sorted_counts = REPORT_WORKER['cur'], REPORT_WORKER['sorted_counts']
+    rows = []
+    for user_id, merged_ids in groups:
+        report = compute_report(cur, merged_ids, sorted_counts=sorted_counts)
+        rows.append((user_id, ','.join(sorted(merged_ids)), pack_report(report)))
+    return rows
+
+
+def build_report_snapshots(min_msgs=REPORT_MIN_MSGS):
+    """批量预生成报告快照 (报告集中开放前跑一次)：每个未被合并的用户按合并后的 ID 集合计算，多进程分批完成"""
+    log_step(">> 预生成年度报告快照...")
+    conn = sqlite3.connect(DB_DATABASE)
+    conn.row_factory = id_row_factory
+    cur = conn.cursor()
+    data_engine.load_merges(cur)
+    cur.execute("SELECT MAX(message_id) FROM messages")
+    db_max_id = str(cur.fetchone()[0] or 0)
+    cur.execute("SELECT user_id, msg_count FROM user_stats WHERE msg_count > 0")
+    counts = {row['user_id']: row['msg_count'] for row in cur.fetchall()}
+    conn.close()
+
+    merges = data_engine.cache['merges']
+    groups = []
+    for user_id in counts:
+        if user_id in merges: continue  # 已合并进其他账号
+        merged_ids = data_engine.get_merged_ids(user_id)
+        if sum(counts.get(i, 0) for i in merged_ids) >= min_msgs: groups.append((user_id, merged_ids))
+    # 百分位在这里一次排好序，交给各进程二分查找
+    sorted_counts = sorted(counts.values())
+    batches = [groups[i:i + REPORT_BATCH_USERS] for i in range(0, len(groups), REPORT_BATCH_USERS)]
+    done = 0
+    with Pool(processes=cpu_count(), initializer=init_report_worker, initargs=(DB_DATABASE, sorted_counts)) as pool:
+        for rows in pool.imap_unordered(report_chunk, batches):
+            data_engine.store.save_reports(db_max_id, rows)
+            done += len(rows)
+            log_step(f"   {done}/{len(groups)}")
+    log_step(f"✅ 已生成 {done} 份报告快照")
+    return done
+
+METRICS = collections.Counter()
+
+VISITOR_UPSERT = "INSERT INTO web_visitors (user_id, username, nickname, avatar_url, last_visit) VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET last_visit=excluded.last_visit, avatar_url=excluded.avatar_url"
+PROFILE_VIEW_UPSERT = "INSERT INTO profile_views (target_user_id, viewer_user_id, viewer_name, viewer_avatar, timestamp) VALUES (?, ?, ?, ?, ?) ON CONFLICT(target_user_id, viewer_user_id) DO UPDATE SET timestamp=excluded.timestamp"
+
+
+class EventWriter:
+    """把访客/主页浏览这类统计事件放进有界队列, 由后台线程定时批量写入, 请求不等待落库。"""
+
+    def __init__(self, maxsize=EVENT_QUEUE_SIZE, interval=EVENT_FLUSH_INTERVAL, writer=write_db, name='event'):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.interval = interval
+        self.writer = writer  # 返回游标的上下文管理器，退出时提交
+        self.name = name  # 计数器前缀，不同队列的计数和队列深度在 /admin/metrics 里分开报告
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, sql, key, params):
+        # 线程在第一次写入时才启动, 这样 gunicorn fork 出的每个 worker 都有自己的写线程
+        if self.thread is None: self.start()
+        try:
+            self.queue.put_nowait((sql, key, params))
+            METRICS[f'{self.name}_queued'] += 1
+        except queue.Full:
+            METRICS[f'{self.name}_dropped'] += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f'{self.name}-writer', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        # 同一用户的重复事件只保留最后一条, 按语句分组后 executemany
+        pending = {}
+        while True:
+            try:
+                sql, key, params = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            pending[(sql, key)] = params
+        if not pending: return
+        batches = collections.defaultdict(list)
+        for (sql, _), params in pending.items(): batches[sql].append(params)
+        try:
+            with self.writer() as cur:
+                for sql, rows in batches.items(): cur.executemany(sql, rows)
+            METRICS[f'{self.name}_written'] += len(pending)
+            METRICS[f'{self.name}_batches'] += 1
+        except Exception as e:
+            METRICS[f'{self.name}_write_errors'] += 1
+            print(f"Event Writer Error ({self.name}): {e}")
+
+    def stats(self):
+        counters = ('queued', 'dropped', 'written', 'batches', 'write_errors')
+        return {**{f'{self.name}_{c}': METRICS[f'{self.name}_{c}'] for c in counters},
+                f'{self.name}_queue_depth': self.queue.qsize(), f'{self.name}_queue_size': self.queue.maxsize}
+
+
+event_writer = EventWriter()
+atexit.register(event_writer.flush)
+
+# 用户主页统计缓存写入 cache_data.db；每批写完顺带清掉过期 (有新消息 / 超过 TTL) 和超出数量上限的旧条目
+USER_CACHE_UPSERT = "INSERT OR REPLACE INTO cache_users (cache_key, last_msg_id, payload, updated_at) VALUES (?, ?, ?, ?)"
+USER_CACHE_PRUNE = "DELETE FROM cache_users WHERE last_msg_id != ? OR updated_at < ? OR cache_key NOT IN (SELECT cache_key FROM cache_users ORDER BY updated_at DESC LIMIT ?)"
+user_cache_writer = EventWriter(writer=data_engine.store.transaction, name='user_cache')
+atexit.register(user_cache_writer.flush)
+
+
+class ResponseCache:
+    """按 (路径, 参数, 数据版本) 缓存渲染好的响应，按字节数做 LRU 淘汰。只能缓存与访问者无关的内容，
+    访客列表、浏览数等由页面再单独请求。响应带 ETag / Last-Modified，浏览器重新验证时直接返回 304。"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def respond(self, build):
+        version, modified = data_engine.data_version(get_db().cursor())
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['version'] == version:
+                self.entries.move_to_end(key)
+                METRICS['response_cache_hits'] += 1
+            else:
+                entry = None
+        if entry is None:
+            METRICS['response_cache_misses'] += 1
+            resp = make_response(build())
+            if resp.status_code != 200: return resp
+            body = resp.get_data()
+            entry = {'version': version, 'modified': modified, 'body': body, 'mimetype': resp.mimetype,
+                     'etag': hashlib.sha1(body).hexdigest()}
+            self.put(key, entry)
+        resp = Response(entry['body'], mimetype=entry['mimetype'])
+        resp.set_etag(entry['etag'])
+        resp.last_modified = entry['modified']
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        return resp.make_conditional(request)
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old: self.size -= len(old['body'])
+            self.entries[key] = entry
+            self.size += len(entry['body'])
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted['body'])
+                METRICS['response_cache_evictions'] += 1
+
+    def stats(self):
+        return {'response_cache_entries': len(self.entries), 'response_cache_bytes': self.size}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MB * 1024 * 1024)
+
+
+class DiscordClient:
+    """Discord API 客户端：所有请求共用一个带连接池的 requests.Session (keep-alive)，每个请求都有超时。
+    429 按 Retry-After 等待后重试；5xx 与连接中断只重试 GET (换取 token 的 code 只能用一次)，
+    POST 只在连接阶段就失败 (请求肯定没有发出) 时重试"""
+
+    def __init__(self, base_url, timeout=DISCORD_HTTP_TIMEOUT, retries=DISCORD_HTTP_RETRIES,
+                 pool_size=DISCORD_HTTP_POOL_SIZE, max_wait=DISCORD_RETRY_MAX_WAIT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.login_ms = collections.deque(maxlen=1000)  # 最近的登录耗时，/admin/metrics 里给出分位数
+
+    def request(self, method, path, **kwargs):
+        for attempt in range(self.retries + 1):
+            METRICS['discord_requests'] += 1
+            try:
+                resp = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            except requests.ConnectionError as e:
+                METRICS['discord_connection_errors'] += 1
+                if attempt == self.retries or (method != 'GET' and not self.failed_to_connect(e)): raise
+                wait = 0.2 * 2 ** attempt
+            else:
+                if resp.status_code == 429:
+                    METRICS['discord_rate_limited'] += 1
+                    wait = self.retry_after(resp)
+                elif resp.status_code >= 500 and method == 'GET':
+                    METRICS['discord_server_errors'] += 1
+                    wait = 0.2 * 2 ** attempt
+                else:
+                    return resp
+                if attempt == self.retries or wait > self.max_wait: return resp
+            METRICS['discord_retries'] += 1
+            time.sleep(wait)
+
+    @staticmethod
+    def failed_to_connect(exc):
+        # 连接超时或建立新连接失败 (拒绝连接 / DNS 解析失败)；读超时、连接被重置等都可能发生在服务端收到请求之后
+        if isinstance(exc, requests.ConnectTimeout): return True
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def retry_after(resp):
+        # Discord 在响应头和 JSON 里都会给出需要等待的秒数 (可能是小数)
+        try:
+            return float(resp.headers.get('Retry-After') or resp.json().get('retry_after', 1))
+        except (ValueError, AttributeError):
+            return 1.0
+
+    def exchange_code(self, code, redirect_uri):
+        data = {'client_id': DISCORD_CLIENT_ID, 'client_secret': DISCORD_CLIENT_SECRET,
+                'grant_type': 'authorization_code', 'code': code, 'redirect_uri': redirect_uri}
+        r = self.request('POST', '/oauth2/token', data=data,
+                         headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        r.raise_for_status()
+        return r.json()
+
+    def get_me(self, access_token):
+        r = self.request('GET', '/users/@me', headers={'Authorization': f"Bearer {access_token}"})
+        r.raise_for_status()
+        return r.json()
+
+    def record_login(self, started, ok):
+        self.login_ms.append((time.perf_counter() - started) * 1000)
+        METRICS['login_ok' if ok else 'login_errors'] += 1
+
+    def stats(self):
+        samples = sorted(self.login_ms)
+        if not samples: return {'login_ms_p50': None, 'login_ms_p95': None, 'login_ms_max': None}
+        return {'login_ms_p50': round(samples[len(samples) // 2], 1),
+                'login_ms_p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+                'login_ms_max': round(samples[-1], 1)}
+
+
+discord_client = DiscordClient(API_BASE_URL)
+
 
 # --- Routes ---
 def login_required(f):
@@ -430,34 +1461,28 @@ def auth_discord(): return redirect(
 def callback():
     code = request.args.get('code')
     if not code: return redirect(url_for('login'))
-    data = {'client_id': DISCORD_CLIENT_ID, 'client_secret': DISCORD_CLIENT_SECRET, 'grant_type': 'authorization_code',
-            'code': code, 'redirect_uri': url_for('callback', _external=True)}
+    started = time.perf_counter()
     try:
-        r = requests.post(f'{API_BASE_URL}/oauth2/token', data=data,
-                          headers={'Content-Type': 'application/x-www-form-urlencoded'});
-        r.raise_for_status();
-        token = r.json()
-        r = requests.get(f'{API_BASE_URL}/users/@me', headers={'Authorization': f"Bearer {token['access_token']}"});
-        r.raise_for_status();
-        user_data = r.json()
+        token = discord_client.exchange_code(code, url_for('callback', _external=True))
+        user_data = discord_client.get_me(token['access_token'])
 
-        conn = get_db();
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO users (user_id, username, nickname, avatar_url, is_bot) VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, nickname=excluded.nickname, avatar_url=excluded.avatar_url",
-            (user_data['id'], user_data['username'], user_data.get('global_name', ''),
-             f"https://cdn.discordapp.com/avatars/{user_data['id']}/{user_data['avatar']}.png", 0))
-        conn.commit()
+        with write_db() as cur:
+            cur.execute(
+                "INSERT INTO users (user_id, username, nickname, avatar_url, is_bot) VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, nickname=excluded.nickname, avatar_url=excluded.avatar_url",
+                (user_data['id'], user_data['username'], user_data.get('global_name', ''),
+                 f"https://cdn.discordapp.com/avatars/{user_data['id']}/{user_data['avatar']}.png", 0))
 
         session['user'] = {'id': user_data['id'], 'username': user_data['username'],
                            'avatar': f"https://cdn.discordapp.com/avatars/{user_data['id']}/{user_data['avatar']}.png"}
         session.permanent = True
+        discord_client.record_login(started, True)
 
         if request.cookies.get('has_seen_report'):
             return redirect(url_for('index'))
         else:
             return redirect(url_for('report'))
     except Exception as e:
+        discord_client.record_login(started, False)
         print(e); return render_template('login.html', error="登录错误")
 
 
@@ -468,40 +1493,30 @@ def logout(): session.pop('user', None); return redirect(url_for('login'))
 @app.route('/')
 @login_required
 def index():
-    conn = get_db();
-    cur = conn.cursor()
     u = session['user']
     now_str = datetime.now(timezone.utc).isoformat()
-    try:
-        cur.execute(
-            "INSERT INTO web_visitors (user_id, username, nickname, avatar_url, last_visit) VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET last_visit=excluded.last_visit, avatar_url=excluded.avatar_url",
-            (u['id'], u['username'], u['username'], u['avatar'], now_str))
-        conn.commit()
-    except Exception as e:
-        print(f"Vis Error: {e}")
+    event_writer.put(VISITOR_UPSERT, u['id'], (u['id'], u['username'], u['username'], u['avatar'], now_str))
+    return response_cache.respond(render_index)
+
 
+def render_index():
+    # 首页对所有人相同 (访客列表由前端请求 /api/visitors)，可整页缓存
+    cur = get_db().cursor()
     data = data_engine.cache.get("homepage", {})
     if not data or not data.get('total_msgs'):
         data_engine.refresh_homepage_stats(cur, 0)
         data = data_engine.cache.get("homepage", {})
 
-    cur.execute("SELECT user_id, nickname, username, avatar_url, last_visit FROM web_visitors ORDER BY last_visit DESC")
-    site_visitors = cur.fetchall()
+    span = parse_day_span(request.args)
+    if span: data = {**data, **fetch_span_summary(cur, span)}
 
-    # 预加载 Top 50 (含表情名)
-    cur.execute(
-        "SELECT u.user_id, u.username, u.nickname, u.avatar_url, count(m.message_id) as msg_count FROM users u JOIN messages m ON u.user_id = m.author_id GROUP BY u.user_id ORDER BY msg_count DESC LIMIT 50")
-    full_leaderboard = []
-    for u in cur.fetchall():
-        d = dict(u);
-        cur.execute(
-            "SELECT emoji_url, emoji_name, count(*) as c FROM reactions r JOIN messages m ON r.message_id=m.message_id WHERE m.author_id=? GROUP BY r.emoji_name ORDER BY count(*) DESC LIMIT 3",
-            (u['user_id'],))
-        d['top_emojis'] = [dict(r) for r in cur.fetchall()]
-        full_leaderboard.append(d)
+    # 预加载 Top 50 (含表情名)，之后由前端带游标请求 /api/leaderboard
+    full_leaderboard = fetch_leaderboard(cur, 50)
+    last = full_leaderboard[-1] if len(full_leaderboard) == 50 else None
+    leaderboard_cursor = encode_cursor(last['msg_count'], last['user_id'], 50) if last else ''
 
-    return render_template('index.html', server_id=SERVER_ID, current_user=session['user'], site_visitors=site_visitors,
-                           full_leaderboard=full_leaderboard, **data)
+    return render_template('index.html', server_id=SERVER_ID, full_leaderboard=full_leaderboard,
+                           leaderboard_cursor=leaderboard_cursor, day_span=span, **data)
 
 
 @app.route('/chouxiangpai')
@@ -512,38 +1527,136 @@ def chouxiangpai_page(): return send_from_directory('templates', 'chouxiangpai.h
 @app.route('/api/leaderboard')
 @login_required
 def api_leaderboard():
-    page = int(request.args.get('page', 1));
-    offset = (page - 1) * 50
-    conn = get_db();
-    conn.row_factory = sqlite3.Row;
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT u.user_id, u.username, u.nickname, u.avatar_url, count(m.message_id) as msg_count FROM users u JOIN messages m ON u.user_id = m.author_id GROUP BY u.user_id ORDER BY msg_count DESC LIMIT 50 OFFSET ?",
-        (offset,))
-    users = []
-    # 【核心修复】后端直接计算Rank，前端只负责显示，解决 101->51 问题
-    start_rank = offset + 1
-    for i, u in enumerate(cur.fetchall()):
-        d = dict(u)
+    return response_cache.respond(render_leaderboard)
+
+
+def render_leaderboard():
+    # 游标翻页: after = "msg_count:user_id:rank" (上一页最后一行)，第 N 页与第 1 页开销相同
+    after = decode_cursor(request.args.get('after'), 3)
+    cur = get_db().cursor()
+    users = fetch_leaderboard(cur, 50, after[:2] if after else None)
+    # 后端直接计算Rank，前端只负责显示
+    start_rank = after[2] + 1 if after else 1
+    for i, d in enumerate(users):
         d['rank'] = start_rank + i  # 绝对排名
+    next_cursor = None
+    if len(users) == 50:
+        next_cursor = encode_cursor(users[-1]['msg_count'], users[-1]['user_id'], users[-1]['rank'])
+    return jsonify({'users': users, 'next_cursor': next_cursor})
+
+
+@app.route('/api/visitors')
+@login_required
+def api_visitors():
+    cur = get_db().cursor()
+    after = request.args.get('after')
+    visitors, next_cursor = fetch_visitors(cur, VISITORS_PER_PAGE, after)
+    for v in visitors: v['last_visit'] = raw_datetime_filter(v['last_visit'])
+    result = {'visitors': visitors, 'next_cursor': next_cursor}
+    if not after:
+        cur.execute("SELECT value FROM web_counters WHERE name = 'visitors'")
+        row = cur.fetchone()
+        result['total'] = row[0] if row else 0
+    return jsonify(result)
+
+
+@app.route('/api/graph')
+@login_required
+def api_graph():
+    return response_cache.respond(render_graph)
+
+
+def render_graph():
+    # 全服互动关系图: 权重最高的 limit 条边 (提及 + 表情) 及其两端用户
+    limit = min(max(int(request.args.get('limit', 300)), 1), 2000)
+    cur = get_db().cursor()
+    cur.execute(
+        "SELECT source_id, target_id, mentions, reactions, mentions + reactions as weight FROM interactions WHERE source_id != target_id ORDER BY mentions + reactions DESC LIMIT ?",
+        (limit,))
+    edges = [dict(r) for r in cur.fetchall()]
+    user_ids = list({uid for e in edges for uid in (e['source_id'], e['target_id'])})
+    nodes = []
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
         cur.execute(
-            "SELECT emoji_url, emoji_name, count(*) as c FROM reactions r JOIN messages m ON r.message_id=m.message_id WHERE m.author_id=? GROUP BY r.emoji_name ORDER BY count(*) DESC LIMIT 3",
-            (u['user_id'],))
-        d['top_emojis'] = [dict(r) for r in cur.fetchall()]
-        users.append(d)
-    return jsonify(users)
+            f"SELECT u.user_id, u.username, u.nickname, u.avatar_url, s.msg_count FROM users u LEFT JOIN user_stats s ON s.user_id = u.user_id WHERE u.user_id IN ({','.join(['?'] * len(chunk))})",
+            chunk)
+        nodes.extend(dict(r) for r in cur.fetchall())
+    return jsonify({'nodes': nodes, 'edges': edges})
 
 
 @app.route('/search')
 @login_required
 def search():
     query = request.args.get('q', '').strip();
+    page = max(request.args.get('page', 1, type=int), 1)
     cur = get_db().cursor()
-    cur.execute("SELECT * FROM users WHERE user_id = ? OR username LIKE ? OR nickname LIKE ? LIMIT 20",
-                (query, f'%{query}%', f'%{query}%'))
+    # 三个字符以上走 trigram 索引；两个字 (字母/数字/汉字) 走二字索引，消息的二字索引只收汉字；
+    # 有索引时更短的词不搜 (否则只能整表扫描)，只按 User ID 精确查找。没建索引时才退回 LIKE
+    use_fts = has_search_index(cur)
+    if not use_fts:
+        mode = 'like' if query else None
+    elif len(query) >= 3:
+        mode = 'trigram'
+    elif len(query) == 2 and NAME_RUN.fullmatch(query):
+        mode = 'bigram'
+    else:
+        mode = None
+    search_messages = mode in ('like', 'trigram') or (mode == 'bigram' and WORD_PATTERN.fullmatch(query))
+    phrase = '"' + (query.lower() if mode == 'bigram' else query).replace('"', '""') + '"'
+    like = f'%{query}%'
+    offset = (page - 1) * SEARCH_PER_PAGE
+
+    cur.execute("SELECT * FROM users WHERE user_id = ?", (query,))
+    users = cur.fetchall()
+    threads, messages = [], []
+    if mode == 'trigram':
+        cur.execute(
+            "SELECT u.* FROM users_fts f JOIN users u ON u.user_id = f.user_id WHERE users_fts MATCH ? ORDER BY f.rank LIMIT 20",
+            (phrase,))
+        users += cur.fetchall()
+        cur.execute(
+            "SELECT t.thread_id, t.name, t.reply_count FROM threads_fts f JOIN threads t ON t.thread_id = f.thread_id WHERE threads_fts MATCH ? ORDER BY f.rank LIMIT 10",
+            (phrase,))
+        threads = cur.fetchall()
+        # 按 bm25 相关度排序
+        cur.execute(
+            "SELECT m.message_id, m.thread_id, m.content, m.ts, t.name as thread_name, u.username, u.nickname, u.avatar_url FROM messages_fts f JOIN messages m ON m.rowid = f.rowid LEFT JOIN threads t ON t.thread_id = m.thread_id LEFT JOIN users u ON u.user_id = m.author_id WHERE messages_fts MATCH ? ORDER BY f.rank LIMIT ? OFFSET ?",
+            (phrase, SEARCH_PER_PAGE + 1, offset))
+        messages = cur.fetchall()
+    elif mode == 'bigram':
+        cur.execute(
+            "SELECT u.* FROM users_bigram f JOIN users u ON u.user_id = f.user_id WHERE users_bigram MATCH ? ORDER BY f.rank LIMIT 20",
+            (phrase,))
+        users += cur.fetchall()
+        cur.execute(
+            "SELECT t.thread_id, t.name, t.reply_count FROM threads_bigram f JOIN threads t ON t.thread_id = f.thread_id WHERE threads_bigram MATCH ? ORDER BY f.rank LIMIT 10",
+            (phrase,))
+        threads = cur.fetchall()
+        if search_messages:
+            cur.execute(
+                "SELECT m.message_id, m.thread_id, m.content, m.ts, t.name as thread_name, u.username, u.nickname, u.avatar_url FROM messages_bigram f JOIN messages m ON m.rowid = f.rowid LEFT JOIN threads t ON t.thread_id = m.thread_id LEFT JOIN users u ON u.user_id = m.author_id WHERE messages_bigram MATCH ? ORDER BY f.rank LIMIT ? OFFSET ?",
+                (phrase, SEARCH_PER_PAGE + 1, offset))
+            messages = cur.fetchall()
+    elif mode == 'like':
+        cur.execute("SELECT * FROM users WHERE username LIKE ? OR nickname LIKE ? LIMIT 20", (like, like))
+        users += cur.fetchall()
+        cur.execute("SELECT thread_id, name, reply_count FROM threads WHERE name LIKE ? ORDER BY reply_count DESC LIMIT 10",
+                    (like,))
+        threads = cur.fetchall()
+        cur.execute(
+            "SELECT m.message_id, m.thread_id, m.content, m.ts, t.name as thread_name, u.username, u.nickname, u.avatar_url FROM messages m LEFT JOIN threads t ON t.thread_id = m.thread_id LEFT JOIN users u ON u.user_id = m.author_id WHERE m.content LIKE ? ORDER BY m.ts DESC LIMIT ? OFFSET ?",
+            (like, SEARCH_PER_PAGE + 1, offset))
+        messages = cur.fetchall()
+    seen = set()
+    users = [u for u in users if not (u['user_id'] in seen or seen.add(u['user_id']))]
+    has_next = len(messages) > SEARCH_PER_PAGE
+
     data = data_engine.cache.get("homepage", {})
-    return render_template('index.html', search_results=cur.fetchall(), query=query, server_id=SERVER_ID,
-                           current_user=session['user'], site_visitors=[], full_leaderboard=[], **data)
+    return render_template('index.html', search_results=users, search_threads=threads,
+                           search_messages=messages[:SEARCH_PER_PAGE], search_page=page, search_has_next=has_next,
+                           search_too_short=bool(query) and not search_messages,
+                           query=query, server_id=SERVER_ID, full_leaderboard=[], **data)
 
 
 @app.route('/user/<user_id>')
@@ -554,119 +1667,80 @@ def user_profile(user_id):
         flash(f"账号 {user_id} 已合并至 {parent_id}");
         return redirect(url_for('user_profile', user_id=parent_id))
 
+    visitor = session.get('user')
+    if visitor and str(visitor['id']) != str(user_id):
+        event_writer.put(PROFILE_VIEW_UPSERT, (user_id, visitor['id']),
+                         (user_id, visitor['id'], visitor['username'], visitor['avatar'],
+                          datetime.now(timezone.utc).isoformat()))
+    return response_cache.respond(lambda: render_user_profile(user_id))
+
+
+def render_user_profile(user_id):
+    # 页面本身与访问者无关，可整页缓存；浏览数 / 认领按钮由前端请求 /api/user/<id>/views
     conn = get_db();
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,));
     user = cur.fetchone()
     if not user: return "User Not Found", 404
 
-    visitor = session.get('user')
-    if visitor and str(visitor['id']) != str(user_id):
-        try:
-            cur.execute(
-                "INSERT INTO profile_views (target_user_id, viewer_user_id, viewer_name, viewer_avatar, timestamp) VALUES (?, ?, ?, ?, ?) ON CONFLICT(target_user_id, viewer_user_id) DO UPDATE SET timestamp=excluded.timestamp",
-                (user_id, visitor['id'], visitor['username'], visitor['avatar'],
-                 datetime.now(timezone.utc).isoformat())); conn.commit()
-        except:
-            pass
-    cur.execute("SELECT COUNT(*) as c FROM profile_views WHERE target_user_id = ?", (user_id,));
-    view_count = cur.fetchone()['c']
-    cur.execute(
-        "SELECT viewer_name, viewer_avatar, timestamp FROM profile_views WHERE target_user_id = ? ORDER BY timestamp DESC LIMIT 20",
-        (user_id,));
-    recent_viewers = cur.fetchall()
-
     merged_ids = data_engine.get_merged_ids(user_id)
     ids_ph = ','.join(['?'] * len(merged_ids))
 
-    cur.execute(f"SELECT count(DISTINCT message_id) as c FROM messages WHERE author_id IN ({ids_ph})", merged_ids)
-    msg_count = cur.fetchone()['c']
-    cur.execute(
-        f"SELECT count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph})",
-        merged_ids)
-    reaction_received_count = cur.fetchone()['c']
+    span = parse_day_span(request.args)
+    stats, charts = data_engine.get_user_data(user_id, cur, span)
 
     sort_by = request.args.get('sort', 'hot');
-    page = int(request.args.get('page', 1));
-    offset = (page - 1) * ITEMS_PER_PAGE
-    msg_order = "ORDER BY total_reactions DESC, m.timestamp DESC" if sort_by == 'hot' else "ORDER BY m.timestamp DESC"
-    cur.execute(
-        f"SELECT m.*, t.name as thread_name, (SELECT count(*) FROM reactions WHERE message_id = m.message_id) as total_reactions FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) {msg_order} LIMIT ? OFFSET ?",
-        (*merged_ids, ITEMS_PER_PAGE, offset))
-    messages = process_messages(cur, cur.fetchall())
-
-    cur.execute(
-        f"""SELECT count(DISTINCT t.thread_id) as c FROM threads t JOIN messages m ON t.thread_id = m.thread_id WHERE m.author_id IN ({ids_ph}) AND m.timestamp = (SELECT min(timestamp) FROM messages WHERE thread_id = t.thread_id)""",
-        merged_ids);
-    thread_count = cur.fetchone()['c']
-    total_thread_pages = math.ceil(thread_count / ITEMS_PER_PAGE)
-    cur.execute(
-        f"""SELECT t.thread_id, t.name, m.timestamp as created_at, (SELECT count(*) FROM messages WHERE thread_id = t.thread_id) as reply_count, (SELECT content FROM messages WHERE thread_id = t.thread_id ORDER BY timestamp ASC LIMIT 1) as first_content, (SELECT message_id FROM messages WHERE thread_id = t.thread_id ORDER BY timestamp ASC LIMIT 1) as op_msg_id FROM threads t JOIN messages m ON t.thread_id = m.thread_id WHERE m.author_id IN ({ids_ph}) AND m.timestamp = (SELECT min(timestamp) FROM messages WHERE thread_id = t.thread_id) ORDER BY reply_count DESC LIMIT ? OFFSET ?""",
-        (*merged_ids, ITEMS_PER_PAGE, offset))
-    raw_my_threads = cur.fetchall();
-    my_threads = []
-    for t in raw_my_threads:
-        d = dict(t);
-        d['op_user'] = user
-        if d['op_msg_id']:
-            cur.execute(
-                "SELECT emoji_url FROM reactions WHERE message_id = ? GROUP BY emoji_name ORDER BY count(*) DESC LIMIT 1",
-                (d['op_msg_id'],));
-            emoji_row = cur.fetchone();
-            d['top_emoji_url'] = emoji_row['emoji_url'] if emoji_row else None
-            cur.execute(
-                "SELECT count(*) as c FROM reactions WHERE message_id = ? GROUP BY emoji_name ORDER BY c DESC LIMIT 1",
-                (d['op_msg_id'],));
-            count_row = cur.fetchone();
-            d['top_emoji_count'] = count_row['c'] if count_row else None
-        my_threads.append(d)
-
-    cur.execute(
-        f"SELECT emoji_url, emoji_name, count(*) as c FROM reactions WHERE user_id IN ({ids_ph}) GROUP BY emoji_name ORDER BY c DESC LIMIT 8",
-        merged_ids);
-    top_emojis_given = [dict(r) for r in cur.fetchall()]
-    cur.execute(
-        f"SELECT r.emoji_url, r.emoji_name, count(*) as c FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph}) GROUP BY r.emoji_name ORDER BY c DESC LIMIT 8",
-        merged_ids);
-    top_emojis_received = [dict(r) for r in cur.fetchall()]
-    cur.execute(
-        f"SELECT u.user_id, u.nickname, u.username, u.avatar_url, COUNT(*) as score FROM (SELECT author_id as source_id FROM mentions WHERE mentioned_user_id IN ({ids_ph}) UNION ALL SELECT r.user_id as source_id FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph})) raw JOIN users u ON raw.source_id = u.user_id WHERE u.user_id NOT IN ({ids_ph}) GROUP BY u.user_id ORDER BY score DESC LIMIT 5",
-        (*merged_ids, *merged_ids, *merged_ids));
-    interactions_incoming = [dict(r) for r in cur.fetchall()]
-    cur.execute(
-        f"SELECT u.user_id, u.nickname, u.username, u.avatar_url, COUNT(*) as score FROM (SELECT mentioned_user_id as target_id FROM mentions WHERE author_id IN ({ids_ph}) UNION ALL SELECT m.author_id as target_id FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE r.user_id IN ({ids_ph})) raw JOIN users u ON raw.target_id = u.user_id WHERE u.user_id NOT IN ({ids_ph}) GROUP BY u.user_id ORDER BY score DESC LIMIT 5",
-        (*merged_ids, *merged_ids, *merged_ids));
-    interactions_outgoing = [dict(r) for r in cur.fetchall()]
-
-    cur.execute(
-        f"SELECT substr(timestamp, 1, 10) as day, count(*) as c FROM messages WHERE author_id IN ({ids_ph}) GROUP BY day",
-        merged_ids);
-    chart_daily = [dict(r) for r in sorted(cur.fetchall(), key=lambda x: x['day'])]
+    # 发言记录用游标翻页 (after = 上一页最后一条的排序键)，走 (author_id, reaction_count, ts) / (author_id, ts) 索引
+    if sort_by == 'hot':
+        sort_keys = ['m.reaction_count', 'm.ts', 'm.message_id']
+    else:
+        sort_keys = ['m.ts', 'm.message_id']
+    after_param = request.args.get('after')
+    after = decode_cursor(after_param, len(sort_keys))
+    keyset = f"AND ({', '.join(sort_keys)}) < ({', '.join(['?'] * len(sort_keys))})" if after else ""
+    ts_where, ts_params = span_ts_filter(span, 'm.ts')
+    threads_after_param = request.args.get('threads_after')
+    rows = []
+    if not threads_after_param:  # "加载更多帖子" 只需要发帖列表
+        cur.execute(
+            f"SELECT m.*, t.name as thread_name FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) {ts_where} {keyset} ORDER BY {', '.join(k + ' DESC' for k in sort_keys)} LIMIT ?",
+            (*merged_ids, *ts_params, *(after or []), ITEMS_PER_PAGE + 1))
+        rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > ITEMS_PER_PAGE:
+        rows = rows[:ITEMS_PER_PAGE]
+        next_cursor = encode_cursor(*(rows[-1][k.split('.')[1]] for k in sort_keys))
+    messages = process_messages(cur, rows)
+
+    # 发帖记录同样用游标翻页 (threads_after = 上一页最后一帖的 reply_count:thread_id)
+    my_threads, threads_next_cursor = [], None
+    if not after_param:  # "加载更多发言" 只需要发言列表
+        threads_after = decode_cursor(threads_after_param, 2)
+        my_threads = fetch_started_threads(cur, merged_ids, ITEMS_PER_PAGE + 1, threads_after, span)
+        if len(my_threads) > ITEMS_PER_PAGE:
+            my_threads = my_threads[:ITEMS_PER_PAGE]
+            threads_next_cursor = encode_cursor(my_threads[-1]['reply_count'], my_threads[-1]['thread_id'])
+        for d in my_threads: d['op_user'] = user
+
+    return render_template('user.html', user=user, messages=messages, my_threads=my_threads, server_id=SERVER_ID,
+                           current_sort=sort_by, next_cursor=next_cursor, threads_next_cursor=threads_next_cursor,
+                           day_span=span, range_query=span_query(request.args),
+                           **stats, **charts)
+
+
+@app.route('/api/user/<user_id>/views')
+@login_required
+def api_user_views(user_id):
+    # 主页上因访问者而异的部分
+    cur = get_db().cursor()
+    cur.execute("SELECT COUNT(*) as c FROM profile_views WHERE target_user_id = ?", (user_id,));
+    view_count = cur.fetchone()['c']
     cur.execute(
-        f"SELECT strftime('%H', timestamp) as hour, count(*) as c FROM messages WHERE author_id IN ({ids_ph}) GROUP BY hour",
-        merged_ids)
-    hourly_raw = {row['hour']: row['c'] for row in cur.fetchall()};
-    chart_hourly = [0] * 24
-    for h, c in hourly_raw.items():
-        try:
-            chart_hourly[(int(h) + 8) % 24] += c
-        except:
-            pass
-    chart_hourly = [{'hour': f"{h:02d}:00", 'c': c} for h, c in enumerate(chart_hourly)]
-
-    cur.execute(f"SELECT content FROM messages WHERE author_id IN ({ids_ph}) ORDER BY timestamp DESC LIMIT 2000",
-                merged_ids)
-    text_list = [r['content'] for r in cur.fetchall()]
-    word_cloud_data = format_word_cloud(get_word_cloud_counter(text_list), 50)
-
-    return render_template('user.html', user=user, messages=messages, my_threads=my_threads, view_count=view_count,
-                           recent_viewers=recent_viewers, server_id=SERVER_ID, current_sort=sort_by, current_page=page,
-                           total_msg_pages=math.ceil(msg_count / ITEMS_PER_PAGE), total_thread_pages=total_thread_pages,
-                           current_user=session['user'],
-                           msg_count=msg_count, reaction_received_count=reaction_received_count,
-                           top_emojis_given=top_emojis_given, top_emojis_received=top_emojis_received,
-                           interactions_incoming=interactions_incoming, interactions_outgoing=interactions_outgoing,
-                           chart_daily=chart_daily, chart_hourly=chart_hourly, word_cloud_data=word_cloud_data)
+        "SELECT viewer_name, viewer_avatar, timestamp FROM profile_views WHERE target_user_id = ? ORDER BY timestamp DESC LIMIT 20",
+        (user_id,));
+    recent_viewers = [dict(r, timestamp=raw_datetime_filter(r['timestamp'])) for r in cur.fetchall()]
+    return jsonify({'view_count': view_count, 'recent_viewers': recent_viewers,
+                    'is_self': str(session['user']['id']) == str(user_id)})
 
 
 @app.route('/claim_account', methods=['POST'])
@@ -683,9 +1757,10 @@ def claim_account():
     t = cur.fetchone()
     if not t: return "目标不存在", 404
     try:
-        cur.execute("INSERT INTO claim_requests_v2 (requester_id, target_id, target_name, created_at) VALUES (?,?,?,?)",
-                    (requester_id, target_id, t['nickname'], datetime.now()));
-        conn.commit()
+        with write_db() as wcur:
+            wcur.execute(
+                "INSERT INTO claim_requests_v2 (requester_id, target_id, target_name, created_at) VALUES (?,?,?,?)",
+                (requester_id, target_id, t['nickname'], datetime.now()))
         flash("认领申请已提交，请等待管理员审核。")
     except:
         flash("申请已存在")
@@ -706,6 +1781,13 @@ def admin_panel():
     return render_template('admin.html', pending_requests=reqs, active_merges=merges)
 
 
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    return jsonify({**METRICS, **event_writer.stats(), **user_cache_writer.stats(), **response_cache.stats(),
+                    **discord_client.stats()})
+
+
 @app.route('/admin/approve/<int:req_id>')
 @admin_required
 def admin_approve(req_id):
@@ -715,34 +1797,36 @@ def admin_approve(req_id):
     cur.execute("SELECT * FROM claim_requests_v2 WHERE id=?", (req_id,));
     req = cur.fetchone()
     if req:
-        cur.execute("UPDATE claim_requests_v2 SET status=1 WHERE id=?", (req_id,))
-        cur.execute("INSERT OR REPLACE INTO user_merges (target_id, parent_id, created_at) VALUES (?,?,?)",
-                    (req['target_id'], req['requester_id'], datetime.now()))
-        conn.commit();
+        with write_db() as wcur:
+            wcur.execute("UPDATE claim_requests_v2 SET status=1 WHERE id=?", (req_id,))
+            wcur.execute("INSERT OR REPLACE INTO user_merges (target_id, parent_id, created_at) VALUES (?,?,?)",
+                         (req['target_id'], req['requester_id'], datetime.now()))
         data_engine.cache['merges'][req['target_id']] = req['requester_id']
+        data_engine.touch_merges()
+        data_engine.invalidate_user(req['target_id'], req['requester_id'])
     return redirect(url_for('admin_panel'))
 
 
 @app.route('/admin/unmerge/<target_id>')
 @admin_required
 def admin_unmerge(target_id):
-    conn = get_db();
-    cur = conn.cursor()
-    cur.execute("DELETE FROM user_merges WHERE target_id=?", (target_id,))
-    conn.commit()
-    if target_id in data_engine.cache['merges']: del data_engine.cache['merges'][target_id]
+    with write_db() as cur:
+        cur.execute("DELETE FROM user_merges WHERE target_id=?", (target_id,))
+    if target_id in data_engine.cache['merges']:
+        data_engine.invalidate_user(target_id, data_engine.cache['merges'].pop(target_id))
+        data_engine.touch_merges()
     return redirect(url_for('admin_panel'))
 
 
 @app.route('/admin/reset_all_claims')
 @admin_required
 def admin_reset_all():
-    conn = get_db();
-    cur = conn.cursor()
-    cur.execute("DELETE FROM claim_requests_v2")
-    cur.execute("DELETE FROM user_merges")
-    conn.commit()
+    with write_db() as cur:
+        cur.execute("DELETE FROM claim_requests_v2")
+        cur.execute("DELETE FROM user_merges")
     data_engine.cache['merges'] = {}
+    data_engine.clear_user_cache()
+    data_engine.touch_merges()
     return redirect(url_for('admin_panel'))
 
 
@@ -760,83 +1844,14 @@ def report():
             db_user = {'user_id': user_id, 'username': session['user']['username'],
                        'avatar_url': session['user']['avatar'], 'nickname': session['user']['username']}
 
-        merged_ids = data_engine.get_merged_ids(user_id);
-        ids_ph = ','.join(['?'] * len(merged_ids))
-
-        report = {}
-        cur.execute(f"SELECT min(timestamp) as joined FROM messages WHERE author_id IN ({ids_ph})", merged_ids)
-        joined_row = cur.fetchone();
-        if joined_row and joined_row['joined']:
-            report['join_date'] = datetimeformat_filter(joined_row['joined'], '%Y-%m-%d')
-        else:
-            report['join_date'] = "未知"
-
-        cur.execute(
-            f"SELECT substr(timestamp, 1, 10) as day, count(*) as c FROM messages WHERE author_id IN ({ids_ph}) GROUP BY day ORDER BY c DESC LIMIT 1",
-            merged_ids)
-        row = cur.fetchone();
-        report['most_active_day'] = dict(row) if row else None
-
-        cur.execute(
-            f"SELECT * FROM messages WHERE author_id IN ({ids_ph}) AND strftime('%H', timestamp) IN ('16','17','18','19','20','21') ORDER BY timestamp DESC LIMIT 1",
-            merged_ids)
-        late = cur.fetchone()
-        if late:
-            d = dict(late);
-            cur.execute("SELECT name FROM threads WHERE thread_id=?", (d['thread_id'],));
-            tn = cur.fetchone()
-            d['thread_name'] = tn['name'] if tn else 'Unknown';
-            report['latest_msg'] = d
-        else:
-            report['latest_msg'] = None
-
-        cur.execute(
-            f"SELECT t.thread_id, t.name, (SELECT count(*) FROM messages WHERE thread_id = t.thread_id) as reply_count FROM threads t JOIN messages m ON t.thread_id = m.thread_id WHERE m.author_id IN ({ids_ph}) AND m.timestamp = (SELECT min(timestamp) FROM messages WHERE thread_id = t.thread_id) ORDER BY reply_count DESC LIMIT 1",
-            merged_ids)
-        row = cur.fetchone();
-        if row:
-            d = dict(row); d['op_user'] = db_user; report['most_replied_thread'] = d
-        else:
-            report['most_replied_thread'] = None
-
-        cur.execute(
-            f"SELECT t.thread_id, t.name, count(*) as c FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) GROUP BY t.thread_id ORDER BY c DESC LIMIT 1",
-            merged_ids)
-        row = cur.fetchone();
-        report['most_active_topic'] = dict(row) if row else None
-
-        cur.execute(
-            f"SELECT m.*, t.name as thread_name, (SELECT count(*) FROM reactions WHERE message_id = m.message_id) as rc FROM messages m JOIN threads t ON m.thread_id = t.thread_id WHERE m.author_id IN ({ids_ph}) ORDER BY rc DESC LIMIT 1",
-            merged_ids)
-        row = cur.fetchone()
-        if row:
-            d = dict(row);
-            cur.execute("SELECT emoji_url, count(*) as count FROM reactions WHERE message_id = ? GROUP BY emoji_name",
-                        (d['message_id'],));
-            d['detailed_reactions'] = [dict(r) for r in cur.fetchall()];
-            report['most_liked_msg'] = d
-        else:
-            report['most_liked_msg'] = None
-
-        cur.execute(
-            f"SELECT u.nickname, u.username, u.avatar_url, COUNT(*) as score FROM (SELECT author_id as source_id FROM mentions WHERE mentioned_user_id IN ({ids_ph}) UNION ALL SELECT r.user_id as source_id FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE m.author_id IN ({ids_ph})) raw JOIN users u ON raw.source_id = u.user_id WHERE u.user_id NOT IN ({ids_ph}) GROUP BY u.user_id ORDER BY score DESC LIMIT 1",
-            (*merged_ids, *merged_ids, *merged_ids))
-        row = cur.fetchone();
-        report['top_friend_incoming'] = dict(row) if row else None
-        cur.execute(
-            f"SELECT u.nickname, u.username, u.avatar_url, COUNT(*) as score FROM (SELECT mentioned_user_id as target_id FROM mentions WHERE author_id IN ({ids_ph}) UNION ALL SELECT m.author_id as target_id FROM reactions r JOIN messages m ON r.message_id = m.message_id WHERE r.user_id IN ({ids_ph})) raw JOIN users u ON raw.target_id = u.user_id WHERE u.user_id NOT IN ({ids_ph}) GROUP BY u.user_id ORDER BY score DESC LIMIT 1",
-            (*merged_ids, *merged_ids, *merged_ids))
-        row = cur.fetchone();
-        report['top_friend_outgoing'] = dict(row) if row else None
-
-        cur.execute(f"SELECT content FROM messages WHERE author_id IN ({ids_ph}) ORDER BY timestamp DESC LIMIT 2000",
-                    merged_ids)
-        text_list = [r['content'] for r in cur.fetchall()]
-        wc = format_word_cloud(get_word_cloud_counter(text_list), 50)
+        merged_ids = data_engine.get_merged_ids(user_id)
+        # ?from=&to= 限定报告的时间范围 (不走快照，直接现算)
+        span = parse_day_span(request.args)
+        report = compute_report(cur, merged_ids, span) if span else data_engine.get_report(user_id, cur)
+        if report['most_replied_thread']: report['most_replied_thread']['op_user'] = db_user
 
         resp = make_response(
-            render_template('report.html', user=db_user, server_id=SERVER_ID, word_cloud_data=wc, percentile=95,
-                            **report))
+            render_template('report.html', user=db_user, server_id=SERVER_ID, day_span=span, **report))
         resp.set_cookie('has_seen_report', '1', max_age=60 * 60 * 24 * 365)
         return resp
     except Exception as e:
@@ -844,6 +1859,11 @@ def report():
 
 
 if __name__ == '__main__':
+    if '--build-reports' in sys.argv:
+        init_db_structure()
+        optimize_database()
+        build_report_snapshots()
+        sys.exit()
     if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         init_db_structure()
         optimize_database()
@@ -0,0 +1,50 @@
+"""首页统计块 (DataEngine.refresh_homepage_stats) 的耗时测试：统计发出的 SQL 条数与墙钟时间。
+冷启动与每次缓存失效重算都要等这一步。
+
+用法 (在仓库根目录，先运行 bench/make_synthetic_db.py)：python bench/bench_homepage.py [--db bench/bench_data.db]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as web  # noqa: E402
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data.db')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if not os.path.exists(args.db): return print(f"错误: 找不到 {args.db}，请先运行 bench/make_synthetic_db.py")
+
+    web.DB_DATABASE = args.db
+    web.CACHE_FILE = os.path.join(tempfile.mkdtemp(), 'cache_data.db')
+    engine = web.DataEngine()
+    conn = sqlite3.connect(args.db)
+    conn.row_factory = web.id_row_factory
+    cur = conn.cursor()
+    cur.execute("SELECT count(*), max(message_id) FROM messages")
+    total, db_max_id = cur.fetchone()
+    # 词频表由 load_or_compute 先行算好，这里不计入首页统计的耗时
+    engine.cache["global_word_counter"] = web.load_term_counts(cur)
+
+    queries = []
+    conn.set_trace_callback(queries.append)
+    print(f"数据库: {args.db} ({total} 条消息)")
+    for i in range(args.repeat):
+        queries.clear()
+        start = time.perf_counter()
+        engine.refresh_homepage_stats(cur, db_max_id)
+        elapsed = time.perf_counter() - start
+        print(f"  第 {i + 1} 次{' (冷)' if i == 0 else ''}: {len(queries)} 条查询, {elapsed * 1000:.1f} ms")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
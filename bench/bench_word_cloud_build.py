@@ -0,0 +1,56 @@
+"""全服词云冷启动构建的吞吐测试：报告 消息数/秒/核。
+分别测两条路径：从消息原文多进程分词 (count_words_parallel，没有倒排表时使用) 与按 term_id 分段汇总倒排表 (load_term_counts)。
+
+用法 (在仓库根目录，先运行 bench/make_synthetic_db.py)：python bench/bench_word_cloud_build.py [--db bench/bench_data.db] [--processes 1 2 4 8]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as web  # noqa: E402
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data.db')
+
+
+def report(name, total, elapsed, counter, processes=None):
+    processes = processes or cpu_count()
+    print(f"  {name}: {elapsed:.2f} s, {total / elapsed:,.0f} 条/秒, {total / elapsed / processes:,.0f} 条/秒/进程 "
+          f"({processes} 个进程, 本机 {cpu_count()} 核, {len(counter)} 个词)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--processes', type=int, nargs='+', default=[cpu_count()],
+                        help="倒排表汇总依次用这些进程数各测一次 (进程数超过核数时看的是总工作量是否随分段数增加)")
+    args = parser.parse_args()
+    if not os.path.exists(args.db): return print(f"错误: 找不到 {args.db}，请先运行 bench/make_synthetic_db.py")
+
+    web.DB_DATABASE = args.db
+    web.CACHE_FILE = os.path.join(tempfile.mkdtemp(), 'cache_data.db')
+    conn = sqlite3.connect(args.db)
+    conn.row_factory = web.id_row_factory
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM messages")
+    total = cur.fetchone()[0]
+    print(f"数据库: {args.db} ({total} 条消息)")
+
+    engine = web.DataEngine()
+    start = time.perf_counter()
+    engine.count_words_parallel(conn, cur, 0, total)
+    report("原文分词", total, time.perf_counter() - start, engine.cache["global_word_counter"])
+
+    for processes in args.processes:
+        start = time.perf_counter()
+        counter = web.load_term_counts(cur, processes)
+        report("倒排表汇总", total, time.perf_counter() - start, counter, processes)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
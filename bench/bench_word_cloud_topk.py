@@ -0,0 +1,79 @@
+"""全服词云精确模式 (WORD_CLOUD_TOP_K = 0) 与有界模式 (Space-Saving 前 K) 的对比：
+父进程内存峰值、结果词频表大小、首页前 60 个词的重合率和计数误差 (应不超过 总词数 / K)。
+
+用法 (在仓库根目录，先运行 bench/make_synthetic_db.py)：python bench/bench_word_cloud_topk.py [--k 2000 5000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as web  # noqa: E402
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data.db')
+CLOUD_SIZE = 60  # 首页词云展示的词数
+
+
+def counter_bytes(counter):
+    return sys.getsizeof(counter) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in counter.items())
+
+
+def build(conn, cur, total, top_k, source):
+    """按给定模式构建一次全服词频，返回 (词频表, 耗时, 父进程内存峰值)"""
+    web.WORD_CLOUD_TOP_K = top_k
+    tracemalloc.start()
+    start = time.perf_counter()
+    if source == 'messages':
+        engine = web.DataEngine()
+        engine.count_words_parallel(conn, cur, 0, total)
+        counter = engine.cache["global_word_counter"]
+    else:
+        counter = web.load_term_counts(cur)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return counter, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--k', type=int, nargs='+', default=[2000, 5000])
+    parser.add_argument('--source', choices=['messages', 'terms'], default='messages',
+                        help="messages: 从消息原文分词 (count_words_parallel)；terms: 汇总倒排表 (load_term_counts)")
+    args = parser.parse_args()
+    if not os.path.exists(args.db): return print(f"错误: 找不到 {args.db}，请先运行 bench/make_synthetic_db.py")
+
+    web.DB_DATABASE = args.db
+    web.CACHE_FILE = os.path.join(tempfile.mkdtemp(), 'cache_data.db')
+    conn = sqlite3.connect(args.db)
+    conn.row_factory = web.id_row_factory
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM messages")
+    total = cur.fetchone()[0]
+    print(f"数据库: {args.db} ({total} 条消息, 数据来源: {args.source})")
+
+    exact, elapsed, peak = build(conn, cur, total, 0, args.source)
+    words = sum(exact.values())
+    exact_top = web.format_word_cloud(exact, CLOUD_SIZE)
+    print(f"  精确模式: {len(exact)} 个词, 词频表 {counter_bytes(exact) / 2 ** 20:.1f} MiB, "
+          f"内存峰值 {peak / 2 ** 20:.1f} MiB, {elapsed:.2f} s")
+
+    for k in args.k:
+        bounded, elapsed, peak = build(conn, cur, total, k, args.source)
+        bounded_top = web.format_word_cloud(bounded, CLOUD_SIZE)
+        overlap = len({w['text'] for w in exact_top} & {w['text'] for w in bounded_top})
+        # 计数误差按精确模式的前 60 个词逐个比较；Space-Saving 只会多算，不会少算
+        errors = [bounded.get(w['text'], 0) - w['weight'] for w in exact_top]
+        print(f"  K = {k}: {len(bounded)} 个词, 词频表 {counter_bytes(bounded) / 2 ** 20:.2f} MiB, "
+              f"内存峰值 {peak / 2 ** 20:.1f} MiB, {elapsed:.2f} s; 前 {CLOUD_SIZE} 重合 {overlap}/{len(exact_top)}, "
+              f"计数误差 [{min(errors)}, {max(errors)}] (上界 {words // k})")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
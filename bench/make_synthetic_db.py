@@ -0,0 +1,111 @@
+"""生成压测用的合成数据库：按 DiscordChatExporter 的帖子格式造数据，走正式导入流程 (collect_thread / write_buffers /
+finish_import) 写库，表结构、派生表和索引都与真实导入一致。
+
+用法 (在仓库根目录)：python bench/make_synthetic_db.py [--messages 1000000] [--out bench/bench_data.db]
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import disocrdDB  # noqa: E402
+
+# ================= 配置 =================
+DEFAULT_MESSAGES = 1_000_000
+DEFAULT_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data.db')
+USERS = 3000
+MSGS_PER_THREAD = 50  # 平均每帖消息数
+VOCAB_SIZE = 30000  # 合成词表大小，词频按 Zipf 分布 (少数高频词 + 长尾)
+DAYS = 730  # 消息时间跨度
+START_MS = 1640995200000  # 2022-01-01 00:00:00 UTC
+EMOJIS = ['👍', '😂', '❤️', '🤔', '🎉', 'pepe', 'doge', 'kek']
+
+
+# =======================================
+
+def zipf_sampler(rng, items, s=1.1):
+    """按 1/rank^s 加权抽样，返回 sample(k) 函数"""
+    cum = list(itertools.accumulate(1 / (i + 1) ** s for i in range(len(items))))
+    total = cum[-1]
+    return lambda k: [items[bisect.bisect_left(cum, rng.random() * total)] for _ in range(k)]
+
+
+def make_vocab(rng):
+    words = set(disocrdDB.STOP_WORDS)
+    while len(words) < VOCAB_SIZE:
+        words.add(''.join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(rng.choice((2, 2, 2, 3, 4)))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def make_users():
+    return [{'id': str(200000000000000000 + i), 'name': f'user{i}', 'nickname': f'成员{i}',
+             'avatarUrl': f'https://cdn.discordapp.com/embed/avatars/{i % 5}.png', 'isBot': False} for i in range(USERS)]
+
+
+def generate_threads(rng, total_messages):
+    """逐帖生成 DiscordChatExporter 格式的 dict；message_id 由时间戳 + 全局序号拼成，保证唯一且随时间递增"""
+    vocab = make_vocab(rng)
+    words = zipf_sampler(rng, vocab)
+    users = make_users()
+    authors = zipf_sampler(rng, users, s=0.9)
+    span_ms = DAYS * 86400000
+    seq = itertools.count()
+    made = 0
+    while made < total_messages:
+        n = min(total_messages - made, max(1, int(rng.expovariate(1 / MSGS_PER_THREAD))))
+        made += n
+        t_start = START_MS + rng.randrange(span_ms)
+        stamps = sorted(t_start + rng.randrange(14 * 86400000) for _ in range(n))
+        messages = []
+        for ms in stamps:
+            m_id = str(((ms - disocrdDB.DISCORD_EPOCH) << 22) | (next(seq) & 0x3FFFFF))
+            content = ' '.join(words(rng.randint(0, 12)))
+            if rng.random() < 0.2: content += ' lol https://example.com'
+            msg = {'id': m_id, 'timestamp': '', 'content': content, 'author': authors(1)[0],
+                   'reactions': [], 'mentions': [], 'attachments': [], 'reference': {}}
+            if rng.random() < 0.3:
+                for emoji in rng.sample(EMOJIS, rng.randint(1, 3)):
+                    msg['reactions'].append({'emoji': {'name': emoji, 'imageUrl': ''}, 'users': authors(rng.randint(1, 5))})
+            if rng.random() < 0.1:
+                msg['mentions'] = authors(1)
+            if messages and rng.random() < 0.15:
+                msg['reference'] = {'messageId': rng.choice(messages)['id']}
+            messages.append(msg)
+        yield {'channel': {'id': messages[0]['id'], 'categoryId': '1', 'name': ''.join(words(rng.randint(2, 5)))},
+               'exportedAt': '2024-01-01T00:00:00', 'messages': messages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument('--out', default=DEFAULT_OUT)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    disocrdDB.DB_FILENAME = args.out
+    rng = random.Random(args.seed)
+    start = time.time()
+    conn, cursor = disocrdDB.open_database(append=False)
+    buffers = disocrdDB.new_buffers()
+    written = 0
+    for thread in generate_threads(rng, args.messages):
+        disocrdDB.collect_thread(buffers, thread)
+        if len(buffers['messages']) >= disocrdDB.BATCH_SIZE:
+            written += disocrdDB.write_buffers(cursor, buffers)
+            for v in buffers.values(): v.clear()
+            print(f"   -> 已写入 {written} 条消息...", end='\r')
+    written += disocrdDB.write_buffers(cursor, buffers)
+    conn.commit()
+    print(f"\n✅ 原始数据 {written} 条，开始生成派生表与索引...")
+    disocrdDB.finish_import(conn, cursor, append=False)
+    print(f"🎉 {args.out} 生成完毕，耗时 {time.time() - start:.1f} 秒")
+
+
+if __name__ == '__main__':
+    main()
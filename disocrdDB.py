@@ -1,108 +1,772 @@
 import sqlite3
-import ijson  # 需要 pip install ijson
+import collections
+import csv
+import glob
+import json
 import os
+import re
+import sys
 import time
+from multiprocessing import Process, Queue, cpu_count
 
 # ================= 配置 =================
 JSON_FILENAME = "抽象派 - 日常冲浪区🏄 - 1019924310665728022.json"
 DB_FILENAME = "discord_data.db"
 SERVER_ID = "915249444721668096"
 BATCH_SIZE = 5000  # 每处理多少条消息写入一次硬盘 (防止内存爆炸)
+TOP_EMOJI_LIMIT = 5  # user_stats 中为每个用户预存的常用表情数量
+DISCORD_EPOCH = 1420070400000  # Discord snowflake 的起始时间 (毫秒)
+INTEGER_IDS = True  # 新建库时 ID 列用 INTEGER (索引约小一半，按 ID 范围查询正确)；False 为旧版 TEXT 结构
+LOCAL_TIME_OFFSET = '+8 hours'  # 网页图表的显示时区 (SQLite 时间修饰符)，activity_rollup 按此时区汇总
+FULLTEXT_SEARCH = True  # 建立 FTS5 trigram 全文索引 (消息原文/帖子名/用户名，中文可搜)；索引体积约为消息原文的数倍
+APPEND_MODE = False  # True: 增量导入 (保留现有数据库，只写入新帖子/新消息，可断点续传)；也可用命令行参数 --append
+
+# 直接导入 DiscordChatExporter 逐帖导出的 JSON (命令行参数 --files)，跳过 clean_json / merge_script 合并步骤
+JSON_FILES_PATTERN = r"backup/**/*.json"
+THREADS_CSV = "all_threads.csv"  # all_threads.py 生成的帖子列表，存在时只导入其中的帖子
+PARSE_WORKERS = cpu_count()  # 解析 JSON 的进程数
+PARSE_QUEUE_SIZE = PARSE_WORKERS * 2  # 解析结果队列上限，写入跟不上时解析进程会等待 (限制内存)
+
+# 词云分词 (导入时分词一次，存入 terms / user_terms，网页端不再重复扫描消息原文)
+WORD_PATTERN = re.compile(r'[\u4e00-\u9fa5]{2,}')
+STOP_WORDS = {'什么', '这个', '那个', '怎么', '可以', '因为', '所以', '但是', '就是', '这就', '感觉', '时候',
+              '现在', '还是', '没有', '一样', '知道', '觉得', '出来', '其实', '这种', '那样', '一下', '然后',
+              '虽然', '不是', '还有', '这里', '那里', '今天', '明天', '真的', '可能', '图片', '表情', '回复',
+              '一个', '一下', '自己', '只是', '非常', '不能', '不要', '需要', '如果', '以及', '我们', '你们',
+              '他们', '看到', '不过', '确实', '已经', '大家', '为什么', '不会', '不是', '这样', '那个', '这么',
+              '那么', '那些', '是不是', '有没有'}
 
 
 # =======================================
 
+# 带用户 ID 列的派生表 -> derived_tables 里的标记名
+DERIVED_ID_COLUMNS = {
+    'user_stats': ('user_id', 'user_stats'),
+    'user_terms': ('user_id', 'term_index'),
+    'user_day_terms': ('user_id', 'term_index'),
+    'activity_rollup': ('user_id', 'activity_rollup'),
+    'interactions': ('source_id', 'interactions'),
+}
+
+
+def column_type(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    for _, name, col_type, *_ in cursor.fetchall():
+        if name == column: return col_type.upper()
+    return None
+
+
+def database_uses_integer_ids(cursor):
+    """已有的库沿用建库时的 ID 类型 (旧版导入器为 TEXT)，只有新建的库才按 INTEGER_IDS"""
+    col_type = column_type(cursor, 'messages', 'message_id')
+    return INTEGER_IDS if col_type is None else col_type == 'INTEGER'
+
+
+def drop_mismatched_derived(cursor, id_type):
+    """ID 类型与 users 不一致的派生表 (早先升级旧库时按 INTEGER 建的) 与 users 连接时用不上主键，删掉后重建"""
+    for table, (column, flag) in DERIVED_ID_COLUMNS.items():
+        col_type = column_type(cursor, table, column)
+        if col_type is None or col_type == id_type: continue
+        print(f">> {table}.{column} 的类型 ({col_type}) 与库中 ID ({id_type}) 不一致，重建该表...")
+        cursor.execute(f"DROP TABLE {table}")
+        try:
+            cursor.execute("DELETE FROM derived_tables WHERE name = ?", (flag,))
+        except sqlite3.OperationalError:
+            pass
+
+
 def create_tables(cursor):
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id TEXT PRIMARY KEY, username TEXT, nickname TEXT, avatar_url TEXT, is_bot BOOLEAN)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS threads (
-        thread_id TEXT PRIMARY KEY, category_id TEXT, name TEXT, exported_at TEXT, guild_id TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS messages (
-        message_id TEXT PRIMARY KEY, thread_id TEXT, author_id TEXT, content TEXT, 
-        timestamp DATETIME, reply_to_msg_id TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS reactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, user_id TEXT, 
+    # INTEGER_IDS: snowflake 存为 64 位整数，messages 直接以 message_id 作为 rowid
+    integer_ids = database_uses_integer_ids(cursor)
+    id_type = 'INTEGER' if integer_ids else 'TEXT'
+    msg_key = 'INTEGER PRIMARY KEY' if integer_ids else 'TEXT PRIMARY KEY'
+    drop_mismatched_derived(cursor, id_type)
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS users (
+        user_id {id_type} PRIMARY KEY, username TEXT, nickname TEXT, avatar_url TEXT, is_bot BOOLEAN)''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS threads (
+        thread_id {id_type} PRIMARY KEY, category_id {id_type}, name TEXT, exported_at TEXT, guild_id {id_type},
+        reply_count INTEGER DEFAULT 0, op_message_id {id_type}, op_author_id {id_type}, created_at INTEGER,
+        owner_id {id_type})''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS messages (
+        message_id {msg_key}, thread_id {id_type}, author_id {id_type}, content TEXT, 
+        timestamp DATETIME, reply_to_msg_id {id_type}, ts INTEGER, reaction_count INTEGER DEFAULT 0)''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS reactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id {id_type}, user_id {id_type}, 
         emoji_name TEXT, emoji_url TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS attachments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, url TEXT, filename TEXT, size_bytes INTEGER)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS mentions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, mentioned_user_id TEXT, author_id TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS user_stats (
-        user_id TEXT PRIMARY KEY, msg_count INTEGER DEFAULT 0,
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id {id_type}, url TEXT, filename TEXT, size_bytes INTEGER)''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS mentions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id {id_type}, mentioned_user_id {id_type}, author_id {id_type})''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS user_stats (
+        user_id {id_type} PRIMARY KEY, msg_count INTEGER DEFAULT 0,
         reaction_received_count INTEGER DEFAULT 0, interaction_score INTEGER DEFAULT 0,
-        first_msg_at DATETIME, last_msg_at DATETIME)''')
+        first_msg_at DATETIME, last_msg_at DATETIME,
+        reaction_given_count INTEGER DEFAULT 0, top_emojis TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS terms (
+        term_id INTEGER PRIMARY KEY, term TEXT UNIQUE)''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS user_terms (
+        user_id {id_type}, term_id INTEGER, count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, term_id)) WITHOUT ROWID''')
+    # 按本地日期分开的词频：网页按时间范围统计词云时，只需合并范围内各天的计数 (全服 / 每个用户各一份)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS day_terms (
+        local_day TEXT, term_id INTEGER, count INTEGER DEFAULT 0,
+        PRIMARY KEY (local_day, term_id)) WITHOUT ROWID''')
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS user_day_terms (
+        user_id {id_type}, local_day TEXT, term_id INTEGER, count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, local_day, term_id)) WITHOUT ROWID''')
+    # 按 (用户, 本地日期, 本地小时) 汇总的发言数与这些消息收到的表情数，网页图表 / 时间范围统计直接读取
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS activity_rollup (
+        user_id {id_type}, local_day TEXT, local_hour INTEGER, c INTEGER DEFAULT 0, reactions INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, local_day, local_hour)) WITHOUT ROWID''')
+    # 用户互动关系 (有向边，带权重)：source 提及了 target / source 给 target 的消息点了表情
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS interactions (
+        source_id {id_type}, target_id {id_type}, mentions INTEGER DEFAULT 0, reactions INTEGER DEFAULT 0,
+        PRIMARY KEY (source_id, target_id)) WITHOUT ROWID''')
+    # 增量导入断点：每批数据与进度在同一个事务里提交
+    cursor.execute('''CREATE TABLE IF NOT EXISTS import_progress (
+        source TEXT PRIMARY KEY, signature TEXT, threads_done INTEGER DEFAULT 0, updated_at DATETIME)''')
+    # 已经按全部消息完整生成过的派生表；增量导入只在这些表上累加差量
+    cursor.execute('''CREATE TABLE IF NOT EXISTS derived_tables (name TEXT PRIMARY KEY, built_at DATETIME)''')
+    if FULLTEXT_SEARCH:
+        create_search_tables(cursor)
+
+
+SEARCH_TABLES = ('messages_fts', 'threads_fts', 'users_fts', 'messages_bigram', 'threads_bigram', 'users_bigram')
+NAME_RUN = re.compile(r'\w{2,}')
+
+
+def create_search_tables(cursor):
+    """FTS5 全文索引：trigram 分词按三字切分，中文无需分词即可做子串搜索；SQLite 不支持时跳过 (网页退回 LIKE)。
+    trigram 搜不了两个字的词，另建一套二字索引：原文预先拆成相邻两字 (空格分隔)，交给 unicode61 按词索引"""
+    try:
+        # 外部内容表：只存索引不存原文，rowid 即 messages 的 rowid
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', tokenize='trigram')''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS threads_fts USING fts5(
+            name, thread_id UNINDEXED, tokenize='trigram')''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, nickname, user_id UNINDEXED, tokenize='trigram')''')
+        # 消息只拆汉字 (两个字母的英文词太多、也太泛)，无内容表：只存索引，rowid 即 messages 的 rowid
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_bigram USING fts5(
+            grams, content='', tokenize="unicode61 tokenchars '_'")''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS threads_bigram USING fts5(
+            grams, thread_id UNINDEXED, tokenize="unicode61 tokenchars '_'")''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_bigram USING fts5(
+            grams, user_id UNINDEXED, tokenize="unicode61 tokenchars '_'")''')
+    except sqlite3.OperationalError as e:
+        print(f"   ⚠️ 当前 SQLite 不支持 FTS5 trigram，跳过全文索引: {e}")
+
+
+def has_search_index(cursor):
+    cursor.execute(f"SELECT count(*) FROM sqlite_master WHERE name IN ({','.join(['?'] * len(SEARCH_TABLES))})",
+                   SEARCH_TABLES)
+    return cursor.fetchone()[0] == len(SEARCH_TABLES)
+
+
+def bigram_text(text, pattern=WORD_PATTERN):
+    """"你好世界" -> "你好 好世 世界"：把 pattern 匹配到的每一段拆成相邻两字"""
+    if not text: return ''
+    return ' '.join(run[i:i + 2] for run in pattern.findall(text.lower()) for i in range(len(run) - 1))
+
+
+def register_search_functions(conn):
+    conn.create_function('cjk_bigrams', 1, bigram_text, deterministic=True)
+    conn.create_function('name_bigrams', 1, lambda text: bigram_text(text, NAME_RUN), deterministic=True)
+
+
+def upgrade_tables(cursor):
+    """给旧版导入器生成的库补齐后来新增的列 (列不存在时才添加并回填)"""
+    upgrades = [
+        ('user_stats', 'reaction_given_count INTEGER DEFAULT 0', None),
+        ('user_stats', 'top_emojis TEXT', None),
+        # 发送时间直接从 snowflake 推出，无需解析 ISO 字符串
+        ('messages', 'ts INTEGER',
+         f"UPDATE messages SET ts = (CAST(message_id AS INTEGER) >> 22) + {DISCORD_EPOCH}"),
+        ('messages', 'reaction_count INTEGER DEFAULT 0',
+         "UPDATE messages SET reaction_count = (SELECT count(*) FROM reactions r WHERE r.message_id = messages.message_id)"),
+        ('threads', 'reply_count INTEGER DEFAULT 0', None),
+        ('threads', 'op_message_id TEXT', None),
+        ('threads', 'op_author_id TEXT', None),
+        ('threads', 'owner_id TEXT', None),
+        ('threads', 'created_at INTEGER', update_thread_stats),
+        ('activity_rollup', 'reactions INTEGER DEFAULT 0', update_activity_rollup),
+    ]
+    for table, column, backfill in upgrades:
+        try:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            continue
+        if callable(backfill):
+            backfill(cursor)
+        elif backfill:
+            cursor.execute(backfill)
+
+
+def snowflake_to_ms(snowflake):
+    return (int(snowflake) >> 22) + DISCORD_EPOCH
+
+
+def local_offset_ms():
+    """LOCAL_TIME_OFFSET 对应的毫秒数；交给 SQLite 解析，保证与 activity_rollup 里 date() 的结果一致"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        return conn.execute("SELECT CAST(round((julianday(0, 'unixepoch', ?) - 2440587.5) * 86400000) AS INTEGER)",
+                            (LOCAL_TIME_OFFSET,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def local_day(ms, offset_ms):
+    return time.strftime('%Y-%m-%d', time.gmtime((ms + offset_ms) // 1000))
 
 
 def create_indexes(cursor):
     print(">> 正在创建索引 (加速查询)...")
     idx_list = [
-        "CREATE INDEX IF NOT EXISTS idx_msg_author ON messages(author_id)",
-        "CREATE INDEX IF NOT EXISTS idx_msg_timestamp ON messages(timestamp)",
-        "CREATE INDEX IF NOT EXISTS idx_msg_thread ON messages(thread_id)",
+        "CREATE INDEX IF NOT EXISTS idx_msg_author_ts ON messages(author_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_msg_author_hot ON messages(author_id, reaction_count, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_msg_ts ON messages(ts)",
+        "CREATE INDEX IF NOT EXISTS idx_msg_thread_ts ON messages(thread_id, ts)",
         "CREATE INDEX IF NOT EXISTS idx_react_user ON reactions(user_id)",
         "CREATE INDEX IF NOT EXISTS idx_react_msg ON reactions(message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_mention_msg ON mentions(message_id)",
+        # 全服词频按 term_id 分段并行汇总；user_terms 的主键以 user_id 开头，没有这个索引每段都要整表扫描
+        "CREATE INDEX IF NOT EXISTS idx_user_terms_term ON user_terms(term_id, count)",
+        "CREATE INDEX IF NOT EXISTS idx_msg_reactions ON messages(reaction_count)",
+        "CREATE INDEX IF NOT EXISTS idx_thread_replies ON threads(reply_count)",
+        "CREATE INDEX IF NOT EXISTS idx_thread_op ON threads(op_author_id, reply_count)",
+        # 全服按时间范围统计 (首页) 时按日期范围读取 activity_rollup，覆盖索引无需回表
+        "CREATE INDEX IF NOT EXISTS idx_rollup_day ON activity_rollup(local_day, local_hour, c, reactions)",
+        "CREATE INDEX IF NOT EXISTS idx_interactions_target ON interactions(target_id)",
+        "CREATE INDEX IF NOT EXISTS idx_interactions_weight ON interactions(mentions + reactions)",
         "CREATE INDEX IF NOT EXISTS idx_stats_count ON user_stats(msg_count)"
     ]
     for sql in idx_list:
         cursor.execute(sql)
 
 
-def process_data():
-    if not os.path.exists(JSON_FILENAME): return print(f"错误: 找不到文件 {JSON_FILENAME}")
+def build_user_stats(cursor):
+    """全量重建 user_stats 物化表 (排行榜直接按 msg_count 索引读取，不再扫描 messages)"""
+    print("   [1/4] 统计用户发言...")
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute('''
+        INSERT INTO user_stats (user_id, msg_count, first_msg_at, last_msg_at)
+        SELECT author_id, COUNT(*), MIN(timestamp), MAX(timestamp)
+        FROM messages GROUP BY author_id
+    ''')
 
-    # 重建数据库
-    if os.path.exists(DB_FILENAME):
-        try:
-            os.remove(DB_FILENAME)
-        except:
-            pass
+    print("   [2/4] 统计用户获赞...")
+    cursor.execute('''
+        SELECT m.author_id, COUNT(r.id) FROM messages m
+        JOIN reactions r ON m.message_id = r.message_id
+        GROUP BY m.author_id
+    ''')
+    cursor.executemany('UPDATE user_stats SET reaction_received_count = ? WHERE user_id = ?',
+                       [(cnt, uid) for uid, cnt in cursor.fetchall()])
+
+    print("   [3/4] 统计用户送出表情...")
+    # 只点表情不发言的用户也会有一行 (msg_count = 0)，排行榜读取时按 msg_count > 0 过滤
+    cursor.execute('''
+        INSERT INTO user_stats (user_id, reaction_given_count)
+        SELECT user_id, COUNT(*) FROM reactions WHERE true GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET reaction_given_count = excluded.reaction_given_count
+    ''')
+
+    print("   [4/4] 统计用户常用表情...")
+    refresh_top_emojis(cursor)
+
+
+def refresh_top_emojis(cursor, user_ids=None):
+    """重算 user_stats.top_emojis；user_ids 为空时重算全部用户"""
+    sql = '''
+        SELECT author_id, emoji_name, emoji_url, c FROM (
+            SELECT m.author_id, r.emoji_name, r.emoji_url, COUNT(*) AS c,
+                   ROW_NUMBER() OVER (PARTITION BY m.author_id ORDER BY COUNT(*) DESC) AS rn
+            FROM reactions r JOIN messages m ON r.message_id = m.message_id
+            {where}
+            GROUP BY m.author_id, r.emoji_name
+        ) WHERE rn <= ? ORDER BY author_id, c DESC
+    '''
+    if user_ids is None:
+        batches = [None]
+    else:
+        user_ids = list(user_ids)
+        batches = [user_ids[i:i + 500] for i in range(0, len(user_ids), 500)]
+    for batch in batches:
+        if batch is None:
+            cursor.execute(sql.format(where=''), (TOP_EMOJI_LIMIT,))
+        else:
+            cursor.execute(sql.format(where=f"WHERE m.author_id IN ({','.join(['?'] * len(batch))})"),
+                           (*batch, TOP_EMOJI_LIMIT))
+        top_emojis = {}
+        for uid, name, url, cnt in cursor.fetchall():
+            top_emojis.setdefault(uid, []).append({'emoji_url': url, 'emoji_name': name, 'c': cnt})
+        cursor.executemany('UPDATE user_stats SET top_emojis = ? WHERE user_id = ?',
+                           [(json.dumps(v, ensure_ascii=False), uid) for uid, v in top_emojis.items()])
+
+
+def update_activity_rollup(cursor, msg_ids=None):
+    """把消息累加进 activity_rollup；msg_ids 为空时全量重建"""
+    sql = f'''
+        INSERT INTO activity_rollup (user_id, local_day, local_hour, c, reactions)
+        SELECT author_id, date(ts / 1000, 'unixepoch', '{LOCAL_TIME_OFFSET}') AS day,
+               CAST(strftime('%H', ts / 1000, 'unixepoch', '{LOCAL_TIME_OFFSET}') AS INTEGER), COUNT(*),
+               coalesce(sum(reaction_count), 0)
+        FROM messages WHERE {{}} AND day IS NOT NULL GROUP BY 1, 2, 3
+        ON CONFLICT(user_id, local_day, local_hour) DO UPDATE SET c = c + excluded.c, reactions = reactions + excluded.reactions
+    '''
+    if msg_ids is None:
+        cursor.execute("DELETE FROM activity_rollup")
+        cursor.execute(sql.format("true"))
+        return
+    msg_ids = list(msg_ids)
+    for i in range(0, len(msg_ids), 500):
+        chunk = msg_ids[i:i + 500]
+        cursor.execute(sql.format(f"message_id IN ({','.join(['?'] * len(chunk))})"), chunk)
+
+
+def update_interactions(cursor, msg_ids=None):
+    """把消息中的提及 / 收到的表情累加进 interactions 边表；msg_ids 为空时全量重建"""
+    mention_sql = '''
+        INSERT INTO interactions (source_id, target_id, mentions)
+        SELECT author_id, mentioned_user_id, count(*) FROM mentions
+        WHERE {} AND author_id IS NOT NULL AND mentioned_user_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT(source_id, target_id) DO UPDATE SET mentions = mentions + excluded.mentions
+    '''
+    reaction_sql = '''
+        INSERT INTO interactions (source_id, target_id, reactions)
+        SELECT r.user_id, m.author_id, count(*) FROM reactions r JOIN messages m ON r.message_id = m.message_id
+        WHERE {} AND r.user_id IS NOT NULL AND m.author_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT(source_id, target_id) DO UPDATE SET reactions = reactions + excluded.reactions
+    '''
+    if msg_ids is None:
+        cursor.execute("DELETE FROM interactions")
+        cursor.execute(mention_sql.format("true"))
+        cursor.execute(reaction_sql.format("true"))
+        return
+    msg_ids = list(msg_ids)
+    for i in range(0, len(msg_ids), 500):
+        chunk = msg_ids[i:i + 500]
+        ph = ','.join(['?'] * len(chunk))
+        cursor.execute(mention_sql.format(f"message_id IN ({ph})"), chunk)
+        cursor.execute(reaction_sql.format(f"r.message_id IN ({ph})"), chunk)
+
+
+def update_thread_stats(cursor, thread_ids=None):
+    """重算帖子的回复数与楼主 (all_threads.csv 的帖主优先，否则为最早一条消息的作者)；thread_ids 为空时重算全部帖子"""
+    sql = '''
+        WITH agg AS (SELECT thread_id, count(*) AS c, min(message_id) AS op FROM messages WHERE {} GROUP BY thread_id)
+        UPDATE threads SET reply_count = agg.c, op_message_id = agg.op, op_author_id = coalesce(threads.owner_id, m.author_id),
+            created_at = m.ts
+        FROM agg JOIN messages m ON m.message_id = agg.op
+        WHERE threads.thread_id = agg.thread_id
+    '''
+    if thread_ids is None:
+        cursor.execute(sql.format("true"))
+        return
+    thread_ids = list(thread_ids)
+    for i in range(0, len(thread_ids), 500):
+        chunk = thread_ids[i:i + 500]
+        cursor.execute(sql.format(f"thread_id IN ({','.join(['?'] * len(chunk))})"), chunk)
+
+
+def update_search_index(cursor, msg_ids=None):
+    """把消息原文写入 messages_fts / messages_bigram；msg_ids 为空时全量重建 (消息只增不改，增量时只需插入新消息)"""
+    if not has_search_index(cursor): return
+    register_search_functions(cursor.connection)
+    if msg_ids is None:
+        cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        cursor.execute("INSERT INTO messages_bigram (messages_bigram) VALUES ('delete-all')")
+        cursor.execute("INSERT INTO messages_bigram (rowid, grams) SELECT rowid, cjk_bigrams(content) FROM messages")
+        return
+    msg_ids = list(msg_ids)
+    for i in range(0, len(msg_ids), 500):
+        chunk = msg_ids[i:i + 500]
+        ph = ','.join(['?'] * len(chunk))
+        cursor.execute(f'''INSERT INTO messages_fts (rowid, content) SELECT rowid, content FROM messages
+            WHERE message_id IN ({ph})''', chunk)
+        cursor.execute(f'''INSERT INTO messages_bigram (rowid, grams) SELECT rowid, cjk_bigrams(content) FROM messages
+            WHERE message_id IN ({ph})''', chunk)
+
+
+def refresh_name_index(cursor):
+    """帖子名与用户名会被增量导入改写，两张表都不大，每次直接整表重建"""
+    if not has_search_index(cursor): return
+    cursor.execute("DELETE FROM threads_fts")
+    cursor.execute("INSERT INTO threads_fts (name, thread_id) SELECT name, thread_id FROM threads WHERE name != ''")
+    cursor.execute("DELETE FROM users_fts")
+    cursor.execute("INSERT INTO users_fts (username, nickname, user_id) SELECT username, nickname, user_id FROM users")
+    register_search_functions(cursor.connection)
+    cursor.execute("DELETE FROM threads_bigram")
+    cursor.execute("INSERT INTO threads_bigram (grams, thread_id) SELECT name_bigrams(name), thread_id FROM threads WHERE name != ''")
+    cursor.execute("DELETE FROM users_bigram")
+    cursor.execute(
+        "INSERT INTO users_bigram (grams, user_id) SELECT name_bigrams(username || ' ' || coalesce(nickname, '')), user_id FROM users")
+
+
+def extract_words(text):
+    """词云分词：连续两个以上汉字，去掉停用词"""
+    if not text: return []
+    return [w for w in WORD_PATTERN.findall(text) if w not in STOP_WORDS]
+
+
+def get_term_ids(cursor, words):
+    """词 -> term_id，词表里没有的先插入"""
+    words = list(words)
+    ids = {}
+    for i in range(0, len(words), 500):
+        chunk = words[i:i + 500]
+        cursor.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", [(w,) for w in chunk])
+        cursor.execute(f"SELECT term, term_id FROM terms WHERE term IN ({','.join(['?'] * len(chunk))})", chunk)
+        ids.update(cursor.fetchall())
+    return ids
+
+
+def write_user_terms(cursor, word_rows):
+    """word_rows: [(message_id, author_id, [词, ...]), ...]，按 (用户, 词) 累加到 user_terms，
+    同时按发送日期 (由 message_id 推出) 累加到 user_day_terms / day_terms"""
+    offset_ms = local_offset_ms()
+    day_counts = collections.Counter()
+    for m_id, author_id, words in word_rows:
+        if not words: continue
+        day = local_day(snowflake_to_ms(m_id), offset_ms)
+        for w in words:
+            day_counts[(author_id, day, w)] += 1
+    if not day_counts: return
+    counts = collections.Counter()
+    server_counts = collections.Counter()
+    for (uid, day, w), c in day_counts.items():
+        counts[(uid, w)] += c
+        server_counts[(day, w)] += c
+    ids = get_term_ids(cursor, {w for _, w in counts})
+    cursor.executemany('''INSERT INTO user_terms (user_id, term_id, count) VALUES (?,?,?)
+        ON CONFLICT(user_id, term_id) DO UPDATE SET count = count + excluded.count''',
+                       [(uid, ids[w], c) for (uid, w), c in counts.items()])
+    cursor.executemany('''INSERT INTO user_day_terms (user_id, local_day, term_id, count) VALUES (?,?,?,?)
+        ON CONFLICT(user_id, local_day, term_id) DO UPDATE SET count = count + excluded.count''',
+                       [(uid, day, ids[w], c) for (uid, day, w), c in day_counts.items()])
+    cursor.executemany('''INSERT INTO day_terms (local_day, term_id, count) VALUES (?,?,?)
+        ON CONFLICT(local_day, term_id) DO UPDATE SET count = count + excluded.count''',
+                       [(day, ids[w], c) for (day, w), c in server_counts.items()])
+
+
+def build_term_index(cursor):
+    """全量重建词云倒排表与分日词频 (用于旧版导入器生成的数据库)"""
+    for table in ('user_terms', 'user_day_terms', 'day_terms'):
+        cursor.execute(f"DELETE FROM {table}")
+    read_cur = cursor.connection.cursor()
+    read_cur.execute("SELECT message_id, author_id, content FROM messages")
+    while True:
+        rows = read_cur.fetchmany(BATCH_SIZE)
+        if not rows: break
+        write_user_terms(cursor, [(m_id, uid, extract_words(content)) for m_id, uid, content in rows])
+
+
+def new_buffers():
+    return {
+        'users': {},  # 用字典去重
+        'threads': [],
+        'messages': [],
+        'attachments': [],
+        'reactions': [],
+        'mentions': [],
+        'words': []  # (message_id, author_id, 分词结果)
+    }
+
+
+def collect_thread(buffers, thread_data):
+    """把一个帖子 (DiscordChatExporter 格式) 拆成各表的行，追加到缓冲区，返回消息数"""
+    # 1. 处理帖子
+    ch = thread_data.get('channel', {})
+    t_id = ch.get('id')
+    buffers['threads'].append((
+        t_id, ch.get('categoryId'), ch.get('name'), thread_data.get('exportedAt'), SERVER_ID
+    ))
+
+    # 2. 处理消息
+    msg_total = 0
+    for msg in thread_data.get('messages', []):
+        msg_total += 1
+        m_id = msg.get('id')
+        auth = msg.get('author', {})
+        author_id = auth.get('id')
+
+        # 缓存用户
+        if author_id not in buffers['users']:
+            buffers['users'][author_id] = (
+                author_id, auth.get('name', ''), auth.get('nickname', ''),
+                auth.get('avatarUrl', ''), auth.get('isBot', False)
+            )
+
+        # 缓存消息
+        ref_id = msg.get('reference', {}).get('messageId')
+        content = msg.get('content', '')
+        buffers['messages'].append((
+            m_id, t_id, author_id, content, msg.get('timestamp'), ref_id, snowflake_to_ms(m_id),
+            sum(len(r.get('users', [])) for r in msg.get('reactions', []))
+        ))
+        buffers['words'].append((m_id, author_id, extract_words(content)))
+
+        # 缓存附件
+        for att in msg.get('attachments', []):
+            buffers['attachments'].append((m_id, att.get('url'), att.get('fileName'), att.get('fileSizeBytes')))
+
+        # 缓存反应
+        for r in msg.get('reactions', []):
+            emoji_name = r.get('emoji', {}).get('name')
+            emoji_url = r.get('emoji', {}).get('imageUrl')
+            for u in r.get('users', []):
+                u_id = u.get('id')
+                if u_id not in buffers['users']:
+                    buffers['users'][u_id] = (u_id, u.get('name', ''), u.get('nickname', ''),
+                                              u.get('avatarUrl', ''), False)
+                buffers['reactions'].append((m_id, u_id, emoji_name, emoji_url))
+
+        # 缓存提及
+        for m_user in msg.get('mentions', []):
+            mu_id = m_user.get('id')
+            if mu_id not in buffers['users']:
+                buffers['users'][mu_id] = (mu_id, m_user.get('name', ''), m_user.get('nickname', ''),
+                                           m_user.get('avatarUrl', ''), False)
+            buffers['mentions'].append((m_id, mu_id, author_id))
+    return msg_total
+
+
+def new_message_ids(cursor, messages):
+    """按 messages 主键查出库里还没有的 message_id"""
+    msg_ids = [m[0] for m in messages]
+    existing = set()
+    for i in range(0, len(msg_ids), 500):
+        chunk = msg_ids[i:i + 500]
+        cursor.execute(f"SELECT message_id FROM messages WHERE message_id IN ({','.join(['?'] * len(chunk))})", chunk)
+        existing.update(str(r[0]) for r in cursor.fetchall())
+    return {m_id for m_id in msg_ids if m_id not in existing}
+
+
+def write_buffers(cursor, buffers, dedupe=False):
+    """全量模式：库是新建的，直接批量写入。
+    dedupe=True 用于重复导出的帖子：只按主键去掉已写入的消息，派生表留给 finish_import 统一重建"""
+    if dedupe:
+        new_ids = new_message_ids(cursor, buffers['messages'])
+        buffers = {key: rows if key in ('users', 'threads') else [r for r in rows if r[0] in new_ids]
+                   for key, rows in buffers.items()}
+        cursor.executemany('''INSERT INTO threads (thread_id, category_id, name, exported_at, guild_id) VALUES (?,?,?,?,?)
+            ON CONFLICT(thread_id) DO UPDATE SET name = excluded.name, exported_at = excluded.exported_at''',
+                           buffers['threads'])
+    cursor.executemany('INSERT OR IGNORE INTO users (user_id, username, nickname, avatar_url, is_bot) VALUES (?,?,?,?,?)',
+                       buffers['users'].values())
+    cursor.executemany('INSERT OR IGNORE INTO threads (thread_id, category_id, name, exported_at, guild_id) VALUES (?,?,?,?,?)',
+                       buffers['threads'])
+    cursor.executemany('INSERT OR IGNORE INTO messages VALUES (?,?,?,?,?,?,?,?)', buffers['messages'])
+    cursor.executemany('INSERT INTO attachments (message_id, url, filename, size_bytes) VALUES (?,?,?,?)',
+                       buffers['attachments'])
+    cursor.executemany('INSERT INTO reactions (message_id, user_id, emoji_name, emoji_url) VALUES (?,?,?,?)',
+                       buffers['reactions'])
+    cursor.executemany('INSERT INTO mentions (message_id, mentioned_user_id, author_id) VALUES (?,?,?)',
+                       buffers['mentions'])
+    write_user_terms(cursor, buffers['words'])
+    return len(buffers['messages'])
+
+
+def write_buffers_append(cursor, buffers):
+    """增量模式：只写入库里还没有的消息 (按 message_id 去重)，并把差量累加进 user_stats"""
+    new_ids = new_message_ids(cursor, buffers['messages'])
+    new_msgs = [m for m in buffers['messages'] if m[0] in new_ids]
+    msg_author = {m[0]: m[2] for m in new_msgs}
+    new_reactions = [r for r in buffers['reactions'] if r[0] in msg_author]
+
+    cursor.executemany('INSERT OR IGNORE INTO users (user_id, username, nickname, avatar_url, is_bot) VALUES (?,?,?,?,?)',
+                       buffers['users'].values())
+    cursor.executemany('''INSERT INTO threads (thread_id, category_id, name, exported_at, guild_id) VALUES (?,?,?,?,?)
+        ON CONFLICT(thread_id) DO UPDATE SET name = excluded.name, exported_at = excluded.exported_at''', buffers['threads'])
+    cursor.executemany('INSERT OR IGNORE INTO messages VALUES (?,?,?,?,?,?,?,?)', new_msgs)
+    cursor.executemany('INSERT INTO attachments (message_id, url, filename, size_bytes) VALUES (?,?,?,?)',
+                       [a for a in buffers['attachments'] if a[0] in msg_author])
+    cursor.executemany('INSERT INTO reactions (message_id, user_id, emoji_name, emoji_url) VALUES (?,?,?,?)',
+                       new_reactions)
+    cursor.executemany('INSERT INTO mentions (message_id, mentioned_user_id, author_id) VALUES (?,?,?)',
+                       [m for m in buffers['mentions'] if m[0] in msg_author])
+    write_user_terms(cursor, [w for w in buffers['words'] if w[0] in msg_author])
+    update_activity_rollup(cursor, msg_author)
+    update_interactions(cursor, msg_author)
+    update_thread_stats(cursor, {m[1] for m in new_msgs})
+    update_search_index(cursor, msg_author)
+
+    # user_stats 差量: [发言数, 获赞数, 送出表情数, 最早发言, 最晚发言]
+    deltas = {}
+    for m_id, _, author_id, _, ts, _, _, _ in new_msgs:
+        d = deltas.setdefault(author_id, [0, 0, 0, None, None])
+        d[0] += 1
+        if ts and (d[3] is None or ts < d[3]): d[3] = ts
+        if ts and (d[4] is None or ts > d[4]): d[4] = ts
+    for m_id, u_id, _, _ in new_reactions:
+        deltas.setdefault(msg_author[m_id], [0, 0, 0, None, None])[1] += 1
+        deltas.setdefault(u_id, [0, 0, 0, None, None])[2] += 1
+    cursor.executemany('''
+        INSERT INTO user_stats (user_id, msg_count, reaction_received_count, reaction_given_count, first_msg_at, last_msg_at)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            msg_count = msg_count + excluded.msg_count,
+            reaction_received_count = reaction_received_count + excluded.reaction_received_count,
+            reaction_given_count = reaction_given_count + excluded.reaction_given_count,
+            first_msg_at = min(coalesce(first_msg_at, excluded.first_msg_at), coalesce(excluded.first_msg_at, first_msg_at)),
+            last_msg_at = max(coalesce(last_msg_at, excluded.last_msg_at), coalesce(excluded.last_msg_at, last_msg_at))
+    ''', [(uid, *d) for uid, d in deltas.items()])
+    # 常用表情无法按差量累加，只重算本批获赞有变化的作者 (与数据在同一事务里，断点续传也不会漏)
+    refresh_top_emojis(cursor, {msg_author[r[0]] for r in new_reactions})
+    return len(new_msgs)
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{int(st.st_mtime)}"
+
+
+def rebuild_search_index(cursor):
+    update_search_index(cursor)
+    refresh_name_index(cursor)
+
+
+def derived_builders(cursor):
+    """[(标记名, 说明, 全量重建函数)]：派生表只有先按全部消息建好，后续每批的差量累加才是对的"""
+    builders = [
+        ('user_stats', '用户统计与常用表情', build_user_stats),
+        ('term_index', '词云倒排表', build_term_index),
+        ('activity_rollup', '活跃度汇总表', update_activity_rollup),
+        ('interactions', '用户互动关系表', update_interactions),
+    ]
+    if has_search_index(cursor):
+        builders.append(('search_index', '全文索引', rebuild_search_index))
+    return builders
+
+
+def mark_derived_built(cursor, names):
+    cursor.executemany("INSERT OR REPLACE INTO derived_tables (name, built_at) VALUES (?, datetime('now'))",
+                       [(n,) for n in names])
+
+
+def build_missing_derived(cursor):
+    """补建还没有完整生成过的派生表 (旧版导入器生成的库、后来新增的表)，返回补建了哪些"""
+    cursor.execute("SELECT name FROM derived_tables")
+    built = {r[0] for r in cursor.fetchall()}
+    missing = [b for b in derived_builders(cursor) if b[0] not in built]
+    if not missing: return []
+    create_indexes(cursor)
+    for name, label, build in missing:
+        print(f">> 补建{label} (仅首次)...")
+        build(cursor)
+    mark_derived_built(cursor, [name for name, _, _ in missing])
+    return [name for name, _, _ in missing]
+
+
+def open_database(append):
+    if not append:
+        # 重建数据库
+        if os.path.exists(DB_FILENAME):
+            try:
+                os.remove(DB_FILENAME)
+            except:
+                pass
 
     conn = sqlite3.connect(DB_FILENAME)
     cursor = conn.cursor()
-    cursor.execute("PRAGMA synchronous = OFF")  # 极速写入模式
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+    if append:
+        # WAL 模式下网页端可以在导入期间继续读取现有数据
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    else:
+        cursor.execute("PRAGMA synchronous = OFF")  # 极速写入模式
+        cursor.execute("PRAGMA journal_mode = MEMORY")
     create_tables(cursor)
+    if append:
+        upgrade_tables(cursor)
+        # 每批差量更新 interactions 都要按 message_id 回查 reactions / mentions，索引必须在第一批之前就位
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_react_msg ON reactions(message_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mention_msg ON mentions(message_id)")
+        # 旧库里新建的派生表是空的，直接累加只会得到本次导入的部分，先按已有消息全量补建
+        build_missing_derived(cursor)
+        conn.commit()
+    return conn, cursor
+
+
+def finish_import(conn, cursor, append):
+    # --- 统计计算 ---
+    create_indexes(cursor)
+
+    print(">> 正在生成统计数据 (预计算)...")
+    if append:
+        # user_stats 已在每批写入时按差量更新，无需再全表 GROUP BY
+        print("   user_stats 已按差量更新")
+    else:
+        build_user_stats(cursor)
+        print("   汇总每日/每小时活跃度...")
+        update_activity_rollup(cursor)
+        print("   统计帖子回复数与楼主...")
+        update_thread_stats(cursor)
+        print("   生成用户互动关系...")
+        update_interactions(cursor)
+        print("   建立全文索引...")
+        update_search_index(cursor)
+        # 词云倒排表在写入每批时已按全部消息累加
+        mark_derived_built(cursor, [name for name, _, _ in derived_builders(cursor)])
+    apply_thread_owners(cursor)
+    refresh_name_index(cursor)
+
+    conn.commit()
+    if not append:
+        # 导入完成后切回 WAL，之后的增量导入与网页读取互不阻塞
+        cursor.execute("PRAGMA journal_mode = WAL").fetchone()
+    conn.close()
+
+
+def process_data(append=False):
+    if not os.path.exists(JSON_FILENAME): return print(f"错误: 找不到文件 {JSON_FILENAME}")
+    # 只有流式读取合并后的大文件才需要 ijson；放在这里导入，网页端 import 本模块时不依赖它。
+    # 必须在 open_database 之前：全量模式会先删掉旧库
+    try:
+        import ijson  # 需要 pip install ijson
+    except ImportError:
+        return print("错误: 缺少 ijson 库。请运行: pip install ijson")
+
+    conn, cursor = open_database(append)
+
+    source = os.path.abspath(JSON_FILENAME)
+    signature = file_signature(JSON_FILENAME)
+    resume_from = 0
+    known_exports = {}
+    if append:
+        cursor.execute("SELECT signature, threads_done FROM import_progress WHERE source = ?", (source,))
+        row = cursor.fetchone()
+        if row and row[0] == signature:
+            resume_from = row[1]
+            print(f"⏩ 检测到未完成的导入，从第 {resume_from + 1} 个帖子继续...")
+        cursor.execute("SELECT thread_id, exported_at FROM threads")
+        known_exports = {str(t_id): exported for t_id, exported in cursor.fetchall()}
 
     print(f"🚀 开始流式处理文件: {JSON_FILENAME}")
     print(f"ℹ️  内存保护模式已开启，每 {BATCH_SIZE} 条消息写入一次...")
 
     # 缓冲区
-    buffers = {
-        'users': {},  # 用字典去重
-        'threads': [],
-        'messages': [],
-        'attachments': [],
-        'reactions': [],
-        'mentions': []
-    }
+    buffers = new_buffers()
 
-    counters = {'msg': 0, 'thread': 0}
+    counters = {'msg': 0, 'thread': 0, 'new_msg': 0, 'skipped_thread': 0}
     start_time = time.time()
 
     def flush_buffers():
         """将缓冲区写入数据库并清空"""
-        if not buffers['messages'] and not buffers['threads']: return
-
-        cursor.executemany('INSERT OR IGNORE INTO users VALUES (?,?,?,?,?)', buffers['users'].values())
-        cursor.executemany('INSERT OR IGNORE INTO threads VALUES (?,?,?,?,?)', buffers['threads'])
-        cursor.executemany('INSERT OR IGNORE INTO messages VALUES (?,?,?,?,?,?)', buffers['messages'])
-        cursor.executemany('INSERT INTO attachments (message_id, url, filename, size_bytes) VALUES (?,?,?,?)',
-                           buffers['attachments'])
-        cursor.executemany('INSERT INTO reactions (message_id, user_id, emoji_name, emoji_url) VALUES (?,?,?,?)',
-                           buffers['reactions'])
-        cursor.executemany('INSERT INTO mentions (message_id, mentioned_user_id, author_id) VALUES (?,?,?)',
-                           buffers['mentions'])
+        if append:
+            counters['new_msg'] += write_buffers_append(cursor, buffers)
+            cursor.execute("INSERT OR REPLACE INTO import_progress VALUES (?, ?, ?, datetime('now'))",
+                           (source, signature, counters['thread']))
+        else:
+            counters['new_msg'] += write_buffers(cursor, buffers)
         conn.commit()
 
         # 清空
-        buffers['users'].clear()
-        buffers['threads'].clear()
-        buffers['messages'].clear()
-        buffers['attachments'].clear()
-        buffers['reactions'].clear()
-        buffers['mentions'].clear()
+        for v in buffers.values():
+            v.clear()
 
-        print(f"   -> 已存入 {counters['msg']} 条消息...", end='\r')
+        print(f"   -> 已存入 {counters['new_msg']} 条消息...", end='\r')
 
     # --- 流式读取核心逻辑 ---
     with open(JSON_FILENAME, 'rb') as f:  # ijson 需要二进制模式打开
@@ -112,56 +776,17 @@ def process_data():
 
         for thread_data in threads_stream:
             counters['thread'] += 1
+            if counters['thread'] <= resume_from: continue
+
+            # 增量模式下，导出时间没有变化的帖子直接跳过
+            if append:
+                t_id = thread_data.get('channel', {}).get('id')
+                old_export = known_exports.get(t_id)
+                if old_export and thread_data.get('exportedAt') and old_export >= thread_data.get('exportedAt'):
+                    counters['skipped_thread'] += 1
+                    continue
 
-            # 1. 处理帖子
-            ch = thread_data.get('channel', {})
-            t_id = ch.get('id')
-            buffers['threads'].append((
-                t_id, ch.get('categoryId'), ch.get('name'), thread_data.get('exportedAt'), SERVER_ID
-            ))
-
-            # 2. 处理消息
-            for msg in thread_data.get('messages', []):
-                counters['msg'] += 1
-                m_id = msg.get('id')
-                auth = msg.get('author', {})
-                author_id = auth.get('id')
-
-                # 缓存用户
-                if author_id not in buffers['users']:
-                    buffers['users'][author_id] = (
-                        author_id, auth.get('name', ''), auth.get('nickname', ''),
-                        auth.get('avatarUrl', ''), auth.get('isBot', False)
-                    )
-
-                # 缓存消息
-                ref_id = msg.get('reference', {}).get('messageId')
-                buffers['messages'].append((
-                    m_id, t_id, author_id, msg.get('content', ''), msg.get('timestamp'), ref_id
-                ))
-
-                # 缓存附件
-                for att in msg.get('attachments', []):
-                    buffers['attachments'].append((m_id, att.get('url'), att.get('fileName'), att.get('fileSizeBytes')))
-
-                # 缓存反应
-                for r in msg.get('reactions', []):
-                    emoji_name = r.get('emoji', {}).get('name')
-                    emoji_url = r.get('emoji', {}).get('imageUrl')
-                    for u in r.get('users', []):
-                        u_id = u.get('id')
-                        if u_id not in buffers['users']:
-                            buffers['users'][u_id] = (u_id, u.get('name', ''), u.get('nickname', ''),
-                                                      u.get('avatarUrl', ''), False)
-                        buffers['reactions'].append((m_id, u_id, emoji_name, emoji_url))
-
-                # 缓存提及
-                for m_user in msg.get('mentions', []):
-                    mu_id = m_user.get('id')
-                    if mu_id not in buffers['users']:
-                        buffers['users'][mu_id] = (mu_id, m_user.get('name', ''), m_user.get('nickname', ''),
-                                                   m_user.get('avatarUrl', ''), False)
-                    buffers['mentions'].append((m_id, mu_id, author_id))
+            counters['msg'] += collect_thread(buffers, thread_data)
 
             # 检测是否需要写入硬盘
             if len(buffers['messages']) >= BATCH_SIZE:
@@ -169,45 +794,165 @@ def process_data():
 
     # 最后一次写入
     flush_buffers()
-    print(f"\n✅ 原始数据导入完成！共处理 {counters['msg']} 条消息。")
+    print(f"\n✅ 原始数据导入完成！共处理 {counters['msg']} 条消息，新增 {counters['new_msg']} 条。")
 
-    # --- 统计计算 ---
-    create_indexes(cursor)
+    print(f"   跳过未更新的帖子 {counters['skipped_thread']} 个")
+    if append:
+        cursor.execute("DELETE FROM import_progress WHERE source = ?", (source,))
+    finish_import(conn, cursor, append)
 
-    print(">> 正在生成统计数据 (预计算)...")
-    print("   [1/2] 统计用户发言...")
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_stats (user_id, msg_count, first_msg_at, last_msg_at)
-        SELECT author_id, COUNT(*), MIN(timestamp), MAX(timestamp)
-        FROM messages GROUP BY author_id
-    ''')
+    print(f"🎉 全部完成！耗时: {time.time() - start_time:.2f} 秒")
 
-    print("   [2/2] 统计用户获赞...")
-    cursor.execute('''
-        SELECT m.author_id, COUNT(r.id) FROM messages m
-        JOIN reactions r ON m.message_id = r.message_id
-        GROUP BY m.author_id
-    ''')
-    reaction_counts = cursor.fetchall()
 
-    # 批量更新获赞数
-    if reaction_counts:
-        cursor.executemany('UPDATE user_stats SET reaction_received_count = ? WHERE user_id = ?',
-                           [(cnt, uid) for uid, cnt in reaction_counts])
+def get_id_from_filename(filename):
+    """从 DiscordChatExporter 文件名中提取帖子 ID，例如 '...[123456].json' -> '123456'"""
+    match = re.search(r'\[(\d+)\]\.json$', filename)
+    return match.group(1) if match else None
+
+
+def load_thread_whitelist():
+    if not os.path.exists(THREADS_CSV): return None
+    valid_ids = set()
+    with open(THREADS_CSV, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            if row.get('id'): valid_ids.add(str(row['id']).strip())
+    return valid_ids
 
-    conn.commit()
-    conn.close()
+
+def load_thread_owners():
+    """all_threads.csv 中记录的帖主 {thread_id: owner_id}"""
+    if not os.path.exists(THREADS_CSV): return {}
+    owners = {}
+    with open(THREADS_CSV, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            t_id, owner_id = str(row.get('id') or '').strip(), str(row.get('owner_id') or '').strip()
+            if t_id and owner_id: owners[t_id] = owner_id
+    return owners
+
+
+def apply_thread_owners(cursor):
+    """用 all_threads.csv 的帖主覆盖楼主 (首楼被删除时，最早一条消息的作者不一定是帖主)"""
+    owners = load_thread_owners()
+    if not owners: return
+    print(f"   写入帖主 ({len(owners)} 个帖子)...")
+    cursor.executemany("UPDATE threads SET owner_id = ?, op_author_id = ? WHERE thread_id = ?",
+                       [(owner_id, owner_id, t_id) for t_id, owner_id in owners.items()])
+
+
+def parse_worker(task_queue, result_queue):
+    """解析进程：每次只读一个帖子文件，拆好行数据后交给写入进程"""
+    while True:
+        path = task_queue.get()
+        if path is None: break
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                thread_data = json.load(f)
+            if not thread_data.get('channel', {}).get('id'):
+                raise ValueError("不是 DiscordChatExporter 帖子导出文件")
+            buffers = new_buffers()
+            msg_total = collect_thread(buffers, thread_data)
+            result_queue.put((path, buffers, msg_total, None))
+        except Exception as e:
+            result_queue.put((path, None, 0, str(e)))
+    result_queue.put(None)
+
+
+def process_files(append=False):
+    """并行导入逐帖 JSON：多进程解析 -> 有界队列 -> 单连接批量写入"""
+    valid_ids = load_thread_whitelist()
+    all_files = []
+    for path in glob.glob(JSON_FILES_PATTERN, recursive=True):
+        t_id = get_id_from_filename(os.path.basename(path))
+        if valid_ids is not None and t_id and t_id not in valid_ids: continue
+        all_files.append(path)
+    if not all_files: return print(f"错误: 没有找到匹配 {JSON_FILES_PATTERN} 的文件")
+
+    conn, cursor = open_database(append)
+    cursor.execute("SELECT thread_id, exported_at FROM threads")
+    known_exports = {str(t_id): exported for t_id, exported in cursor.fetchall()}
+
+    workers = max(1, min(PARSE_WORKERS, len(all_files)))
+    print(f"🚀 开始并行导入 {len(all_files)} 个文件 ({workers} 个解析进程)")
+    print(f"ℹ️  每 {BATCH_SIZE} 条消息写入一次，解析队列上限 {PARSE_QUEUE_SIZE} 个帖子...")
+
+    task_queue, result_queue = Queue(), Queue(maxsize=PARSE_QUEUE_SIZE)
+    for path in all_files: task_queue.put(path)
+    for _ in range(workers): task_queue.put(None)
+    procs = [Process(target=parse_worker, args=(task_queue, result_queue), daemon=True) for _ in range(workers)]
+    for p in procs: p.start()
+
+    buffers = new_buffers()
+    pending_threads = set()
+    counters = {'msg': 0, 'file': 0, 'new_msg': 0, 'skipped_thread': 0, 'error': 0}
+    start_time = time.time()
+
+    def flush_buffers():
+        if append:
+            counters['new_msg'] += write_buffers_append(cursor, buffers)
+        else:
+            counters['new_msg'] += write_buffers(cursor, buffers)
+        conn.commit()
+        for v in buffers.values():
+            v.clear()
+        pending_threads.clear()
+        print(f"   -> 已处理 {counters['file']}/{len(all_files)} 个文件，存入 {counters['new_msg']} 条消息...", end='\r')
+
+    running = workers
+    while running:
+        item = result_queue.get()
+        if item is None:
+            running -= 1
+            continue
+        path, thread_buffers, msg_total, error = item
+        counters['file'] += 1
+        if error:
+            counters['error'] += 1
+            print(f"\n⚠️  跳过 {path}: {error}")
+            continue
+
+        # 同一个帖子可能被导出多次：没有更新的直接跳过，更新过的按 message_id 去重后写入
+        t_id, _, _, exported_at, _ = thread_buffers['threads'][0]
+        old_export = known_exports.get(t_id)
+        if old_export and exported_at and old_export >= exported_at:
+            counters['skipped_thread'] += 1
+            continue
+        counters['msg'] += msg_total
+        # 同一批里不能出现同一个帖子两次，否则去重查不到尚未写入的那份
+        if t_id in pending_threads:
+            flush_buffers()
+        if old_export and not append:
+            # 全量模式的批量写入不去重，重复导出的帖子单独按主键去重后写入原始数据
+            counters['new_msg'] += write_buffers(cursor, thread_buffers, dedupe=True)
+            conn.commit()
+        else:
+            for key, rows in thread_buffers.items():
+                if key == 'users':
+                    buffers[key].update(rows)
+                else:
+                    buffers[key].extend(rows)
+            pending_threads.add(t_id)
+        known_exports[t_id] = exported_at or ''
+
+        if len(buffers['messages']) >= BATCH_SIZE:
+            flush_buffers()
+
+    for p in procs: p.join()
+    flush_buffers()
+    print(f"\n✅ 原始数据导入完成！共处理 {counters['msg']} 条消息，新增 {counters['new_msg']} 条。")
+    print(f"   跳过未更新的帖子 {counters['skipped_thread']} 个，读取失败 {counters['error']} 个")
+    finish_import(conn, cursor, append)
 
     print(f"🎉 全部完成！耗时: {time.time() - start_time:.2f} 秒")
 
 
 if __name__ == "__main__":
     try:
-        process_data()
-    except ImportError:
-        print("错误: 缺少 ijson 库。请运行: pip install ijson")
+        if '--files' in sys.argv:
+            process_files(append=APPEND_MODE or '--append' in sys.argv)
+        else:
+            process_data(append=APPEND_MODE or '--append' in sys.argv)
     except Exception as e:
         print(f"\n❌ 发生错误: {e}")
         import traceback
 
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()